@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2014  Johannes Schauer <j.schauer@email.de>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+# packing of frames into texture sheets
+#
+# rectangles are placed with the skyline bottom-left heuristic: the sheet
+# keeps the outline of the placed rectangles as a list of horizontal segments
+# and every rectangle goes to the position where its top edge ends up lowest
+
+import math
+import numpy as np
+
+# smallest rectangle containing all pixels for which mask is set
+# returns left, top, right and bottom or None if no pixel is set
+def bbox(mask):
+    rows = np.flatnonzero(mask.any(axis=1))
+    if len(rows) == 0:
+        return None
+    cols = np.flatnonzero(mask.any(axis=0))
+    return cols[0],rows[0],cols[-1]+1,rows[-1]+1
+
+class Skyline(object):
+    def __init__(self, width, maxheight):
+        self.width = width
+        self.maxheight = maxheight
+        # segments of the outline as x, y and width
+        self.segments = [(0,0,width)]
+
+    @property
+    def height(self):
+        return max(y for _,y,_ in self.segments)
+
+    # the lowest position at which a w x h rectangle fits or None
+    def find(self, w, h):
+        best = None
+        for i,(x,_,_) in enumerate(self.segments):
+            if x+w > self.width:
+                break
+            # the rectangle rests on the highest segment below it
+            y,j = 0,i
+            while j < len(self.segments) and self.segments[j][0] < x+w:
+                y = max(y, self.segments[j][1])
+                j += 1
+            if y+h <= self.maxheight and (best is None or (y+h,x) < (best[1]+h,best[0])):
+                best = (x,y)
+        return best
+
+    def place(self, x, y, w, h):
+        segments = []
+        for sx,sy,sw in self.segments:
+            # keep the parts of the segments left and right of the rectangle
+            if sx < x:
+                segments.append((sx,sy,min(sw,x-sx)))
+            if sx+sw > x+w:
+                start = max(sx,x+w)
+                segments.append((start,sy,sx+sw-start))
+        segments.append((x,y+h,w))
+        segments.sort()
+        # merge neighbouring segments of the same height
+        self.segments = []
+        for seg in segments:
+            if self.segments and self.segments[-1][1] == seg[1]:
+                px,py,pw = self.segments[-1]
+                self.segments[-1] = (px,py,pw+seg[2])
+            else:
+                self.segments.append(seg)
+
+# pack rectangles given as a list of (w,h) into as few sheets of at most
+# maxsize x maxsize as possible
+# returns a list of (sheet,x,y) in the order of the input and a list of the
+# width and height of every sheet
+def pack(sizes, maxsize=2048, padding=1):
+    sizes = [(w+padding,h+padding) for w,h in sizes]
+    area = sum(w*h for w,h in sizes)
+    widest = max([w for w,_ in sizes] or [1])
+    if widest > maxsize or max([h for _,h in sizes] or [1]) > maxsize:
+        raise ValueError("frame larger than the maximum sheet size")
+    # roughly square sheets, but never narrower than the widest rectangle
+    width = min(maxsize, max(widest, int(math.ceil(math.sqrt(area)*1.1))))
+
+    order = sorted(range(len(sizes)), key=lambda i: (-sizes[i][1],-sizes[i][0]))
+    positions = [None]*len(sizes)
+    sheets = []
+    for i in order:
+        w,h = sizes[i]
+        for n,sheet in enumerate(sheets):
+            pos = sheet.find(w, h)
+            if pos:
+                break
+        else:
+            sheet = Skyline(width, maxsize)
+            sheets.append(sheet)
+            n,pos = len(sheets)-1,(0,0)
+        sheet.place(pos[0], pos[1], w, h)
+        positions[i] = (n,pos[0],pos[1])
+    return positions,[(s.width,max(s.height,1)) for s in sheets]
@@ -0,0 +1,400 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2014  Johannes Schauer <j.schauer@email.de>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+# benchmarks on synthetic data because the original game data cannot be
+# shipped with these scripts
+
+import os
+import sys
+import struct
+import random
+import time
+import json
+import shutil
+import tempfile
+import zlib
+from StringIO import StringIO
+import numpy as np
+from PIL import Image
+import defdecode
+import defextract
+import lodextract
+import makedef
+import quantize
+import pcx
+
+# create a random stream of segments covering exactly n pixels
+# maxlen is the maximum segment length and rlecolors the colors that can be
+# run length encoded, the returned list contains (color,length) tuples for rle
+# and lists of colors for raw segments
+def synth_segments(rng, n, maxlen, rlecolors):
+    segments = []
+    while n > 0:
+        length = min(rng.randint(1,maxlen), n)
+        if rng.random() < 0.5:
+            segments.append((rng.choice(rlecolors),length))
+        else:
+            segments.append([rng.randint(8,254) for i in range(length)])
+        n -= length
+    return segments
+
+def pack1(segments):
+    r = ''
+    for s in segments:
+        if isinstance(s, list):
+            r += struct.pack("<BB%dB"%len(s), 0xff, len(s)-1, *s)
+        else:
+            r += struct.pack("<BB", s[0], s[1]-1)
+    return r
+
+def pack23(segments):
+    r = ''
+    for s in segments:
+        if isinstance(s, list):
+            r += struct.pack("<B%dB"%len(s), (7<<5) | (len(s)-1), *s)
+        else:
+            r += struct.pack("<B", (s[0]<<5) | (s[1]-1))
+    return r
+
+# return a synthetic frame including its 32 byte header
+def synth_frame(rng, fmt, w, h):
+    if fmt == 0:
+        data = ''.join(chr(rng.randint(0,255)) for i in range(w*h))
+    elif fmt == 1:
+        rows = [pack1(synth_segments(rng, w, 256, range(0,255))) for y in range(h)]
+        lineoffs = []
+        acc = 4*h
+        for r in rows:
+            lineoffs.append(acc)
+            acc += len(r)
+        data = struct.pack("<%dI"%h, *lineoffs)+''.join(rows)
+    elif fmt == 2:
+        rows = [pack23(synth_segments(rng, w, 32, range(0,7))) for y in range(h)]
+        lineoffs = []
+        acc = 2*h+2
+        for r in rows:
+            lineoffs.append(acc)
+            acc += len(r)
+        data = struct.pack("<%dH"%h, *lineoffs)+"\0\0"+''.join(rows)
+    elif fmt == 3:
+        blocks = [pack23(synth_segments(rng, 32, 32, range(0,7))) for i in range((w/32)*h)]
+        lineoffs = []
+        acc = (w/16)*h
+        for b in blocks:
+            lineoffs.append(acc)
+            acc += len(b)
+        data = struct.pack("<%dH"%((w/32)*h), *lineoffs)+''.join(blocks)
+    return struct.pack("<IIIIIIii",len(data),fmt,w,h,w,h,0,0)+data
+
+# the decoder as it was implemented in defextract before the defdecode module
+# existed, kept as a baseline
+def legacy_decode(f, offs):
+    f.seek(offs)
+    pixeldata = ""
+    _,fmt,fw,fh,w,h,lm,tm = struct.unpack("<IIIIIIii", f.read(32))
+    if fmt == 0:
+        pixeldata = f.read(w*h)
+    elif fmt == 1:
+        lineoffs = struct.unpack("<"+"I"*h, f.read(4*h))
+        for lineoff in lineoffs:
+            f.seek(offs+32+lineoff)
+            totalrowlength=0
+            while totalrowlength<w:
+                code,length = struct.unpack("<BB", f.read(2))
+                length+=1
+                if code == 0xff: #raw data
+                    pixeldata += f.read(length)
+                else: # rle
+                    pixeldata += length*chr(code)
+                totalrowlength+=length
+    elif fmt == 2:
+        lineoffs = struct.unpack("<%dH"%h, f.read(2*h))
+        _,_ = struct.unpack("<BB", f.read(2)) # unknown
+        for lineoff in lineoffs:
+            f.seek(offs+32+lineoff)
+            totalrowlength=0
+            while totalrowlength<w:
+                segment, = struct.unpack("<B", f.read(1))
+                code = segment>>5
+                length = (segment&0x1f)+1
+                if code == 7: # raw data
+                    pixeldata += f.read(length)
+                else: # rle
+                    pixeldata += length*chr(code)
+                totalrowlength+=length
+    elif fmt == 3:
+        lineoffs = [struct.unpack("<"+"H"*(w/32), f.read(w/16)) for i in range(h)]
+        for lineoff in lineoffs:
+            for i in lineoff:
+                f.seek(offs+32+i)
+                totalblocklength=0
+                while totalblocklength<32:
+                    segment, = struct.unpack("<B", f.read(1))
+                    code = segment>>5
+                    length = (segment&0x1f)+1
+                    if code == 7: # raw data
+                        pixeldata += f.read(length)
+                    else: # rle
+                        pixeldata += length*chr(code)
+                    totalblocklength+=length
+    return pixeldata
+
+def timeit(func, repeat):
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        func()
+        elapsed = time.time()-start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def bench_decode(sizes, repeat):
+    rng = random.Random(0)
+    print "fmt\twidth\theight\tlegacy\tdefdecode\tspeedup"
+    for fmt in range(4):
+        for w,h in sizes:
+            if fmt == 2:
+                # format 2 frames are always 32x32
+                w,h = 32,32
+            try:
+                data = synth_frame(rng, fmt, w, h)
+            except struct.error:
+                # offsets of format 2 and 3 are limited to an ushort
+                print "%d\t%d\t%d\tframe too large for this format"%(fmt,w,h)
+                continue
+            f = StringIO(data)
+            expected = legacy_decode(f, 0)
+            _,pixels = defdecode.decode_frame(data, 0)
+            if pixels.tostring() != expected:
+                print "decoders disagree for format %d at %dx%d"%(fmt,w,h)
+                return False
+            told = timeit(lambda: legacy_decode(f, 0), repeat)
+            tnew = timeit(lambda: defdecode.decode_frame(data, 0), repeat)
+            print "%d\t%d\t%d\t%.4f\t%.4f\t\t%.1f"%(fmt,w,h,told,tnew,told/max(tnew,1e-9))
+            if fmt == 2:
+                break
+    return True
+
+# synthetic frame resembling a creature: a transparent background, an
+# elliptic body made of runs of regular colors and a shadow below it
+# formats 2 and 3 are used for map objects and only have the special colors
+# 0-6 available for run length encoding which doesn't make a difference here
+def synth_pixels(rng, w, h):
+    pixels = np.zeros((h,w), dtype=np.uint8)
+    y,x = np.ogrid[:h,:w]
+    body = ((x-w/2.0)/(w/3.0))**2+((y-h/2.5)/(h/3.0))**2 < 1
+    shadow = ((x-w/2.0)/(w/3.0))**2+((y-h*0.8)/(h/10.0))**2 < 1
+    runs = np.repeat(rng.randint(8,256,w*h), rng.randint(1,12,w*h))[:w*h]
+    pixels[shadow] = 4
+    pixels[body] = runs.reshape(h,w)[body]
+    return pixels
+
+# assemble a DEF from encoded frames, groups is a list of lists of frame
+# payloads as returned by the encoders
+def build_def(t, fmt, w, h, pal, groups):
+    out = struct.pack("<IIII", t, w, h, len(groups)) + struct.pack("768B", *pal)
+    offset = len(out)+sum(16+17*len(l) for l in groups)
+    table = ''
+    blobs = []
+    for bid,l in enumerate(groups):
+        table += struct.pack("<IIII", bid, len(l), 0, 0)
+        table += ''.join(struct.pack("13s", "%02d_%03d.pcx"%(bid,i)) for i in range(len(l)))
+        for data in l:
+            table += struct.pack("<I", offset)
+            blobs.append(struct.pack("<IIIIIIii",len(data),fmt,w,h,w,h,0,0)+str(data))
+            offset += len(blobs[-1])
+    return out+table+''.join(blobs)
+
+# assemble a LOD from (name,data,compress) tuples
+def build_lod(members, level=6):
+    header = 'LOD\0'+struct.pack("<II", 200, len(members))+'\0'*80
+    offset = len(header)+32*len(members)
+    table = ''
+    blobs = []
+    for name,data,compress in members:
+        blob = zlib.compress(data, level) if compress else data
+        table += struct.pack("<16sIIII", name, offset, len(data), 0, len(blob) if compress else 0)
+        blobs.append(blob)
+        offset += len(blob)
+    return header+table+''.join(blobs)
+
+class Results(object):
+    def __init__(self):
+        self.results = []
+        print "%-24s%-6s%10s%12s%12s"%("stage","fmt","seconds","MiB/s","frames/s")
+
+    def add(self, stage, seconds, nbytes=0, frames=0, fmt=None):
+        seconds = max(seconds, 1e-9)
+        r = {"stage":stage, "format":fmt, "seconds":seconds, "bytes":nbytes,
+             "frames":frames, "mb_per_s":nbytes/seconds/(1<<20),
+             "frames_per_s":frames/seconds}
+        self.results.append(r)
+        print "%-24s%-6s%10.4f%12.2f%12.1f"%(stage, "-" if fmt is None else fmt,
+            seconds, r["mb_per_s"], r["frames_per_s"])
+
+# run func with stdout discarded, the tools print every file they write
+def quiet(func):
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    try:
+        return func()
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+def bench_lod(res, tmpdir, repeat, nmembers):
+    rng = np.random.RandomState(0)
+    members = []
+    for i in range(nmembers):
+        data = np.repeat(rng.randint(0,256,1024), rng.randint(1,8,1024)).astype(np.uint8).tostring()
+        members.append(("member%04d.bin"%i, data, i%4 != 0))
+    path = os.path.join(tmpdir, "bench.lod")
+    with open(path, "wb") as f:
+        f.write(build_lod(members))
+    def parse():
+        with lodextract.LodArchive(path) as lod:
+            lod.index
+    res.add("lod-directory", timeit(parse, repeat), 32*nmembers, 0)
+    total = sum(len(m[1]) for m in members)
+    def read():
+        with lodextract.LodArchive(path) as lod:
+            for name in lod:
+                lod.read(name)
+    res.add("lod-decompress", timeit(read, repeat), total, 0)
+    outdir = os.path.join(tmpdir, "lod.out")
+    os.mkdir(outdir)
+    res.add("lod-extract", timeit(lambda: quiet(lambda: lodextract.unpack_lods([path], outdir, 1)), repeat), total, 0)
+    # paletted bitmaps of the size of a typical H3bitmap.lod member
+    bitmaps = [pcx.encode(rng.randint(0,256,(64,64)).astype(np.uint8),
+                          rng.randint(0,256,768).astype(np.uint8)) for i in range(nmembers)]
+    npix = 64*64*nmembers
+    res.add("pcx-read", timeit(lambda: [pcx.read(b) for b in bitmaps], repeat), npix, nmembers)
+    images = [pcx.read(b) for b in bitmaps]
+    res.add("pcx-write", timeit(lambda: [pcx.write(im) for im in images], repeat), npix, nmembers)
+
+def bench_def(res, tmpdir, repeat, fmt, w, h, nframes):
+    rng = np.random.RandomState(fmt)
+    if fmt == 2:
+        w,h = 32,32
+    if fmt == 3:
+        w = (w/32)*32
+    frames = [synth_pixels(rng, w, h) for i in range(nframes)]
+    pal = rng.randint(0,256,768).tolist()
+    npix = w*h*nframes
+
+    payloads = []
+    def encode():
+        payloads[:] = [makedef.fmtencoders[fmt](px)[0] for px in frames]
+    res.add("rle-encode", timeit(encode, repeat), npix, nframes, fmt)
+    if fmt == 1:
+        res.add("rle-encode-optimal", timeit(lambda: [makedef.encode1(px, True) for px in frames], repeat), npix, nframes, fmt)
+    if None in payloads:
+        print "frames of %dx%d are too large for format %d"%(w,h,fmt)
+        return
+
+    data = build_def(0x42, fmt, w, h, pal, [payloads])
+    offsets = defdecode.parse_header(data)[2][0]
+    res.add("rle-decode", timeit(lambda: [defdecode.decode_frame(data, o) for o in offsets], repeat), npix, nframes, fmt)
+
+    lut = defextract.rgba_lut(pal)
+    images = [Image.fromarray(lut[px], 'RGBA') for px in frames]
+    def png():
+        for im in images:
+            im.save(StringIO(), "png")
+    res.add("png-encode", timeit(png, repeat), 4*npix, nframes, fmt)
+
+    defpath = os.path.join(tmpdir, "bench%d.def"%fmt)
+    with open(defpath, "wb") as f:
+        f.write(data)
+    outdir = os.path.join(tmpdir, "def%d.out"%fmt)
+    os.mkdir(outdir)
+    res.add("def-extract", timeit(lambda: quiet(lambda: defextract.extract_def(defpath, outdir)), repeat), len(data), nframes, fmt)
+
+    def quant():
+        q = quantize.Quantizer()
+        for im in images:
+            q.add(im)
+        q.build()
+        for im in images:
+            q.quantize(im)
+    res.add("quantize", timeit(quant, repeat), 4*npix, nframes, fmt)
+
+    # makedef from the paletted frames and from the RGBA frames written by
+    # defextract
+    pdir = os.path.join(tmpdir, "p%d"%fmt)
+    os.mkdir(pdir)
+    seq = []
+    for i,px in enumerate(frames):
+        im = Image.fromarray(px)
+        im.putpalette(pal)
+        im.save(os.path.join(pdir, "%03d.png"%i))
+        seq.append("%03d.png"%i)
+    pjson = os.path.join(pdir, "bench%d.json"%fmt)
+    with open(pjson, "w") as f:
+        json.dump({"type":0x42,"format":fmt,"sequences":[{"group":0,"frames":seq}]}, f)
+    res.add("makedef-write", timeit(lambda: quiet(lambda: makedef.makedef(pjson, tmpdir)), repeat), npix, nframes, fmt)
+    rgbajson = os.path.join(outdir, "bench%d.json"%fmt)
+    res.add("makedef-write-rgba", timeit(lambda: quiet(lambda: makedef.makedef(rgbajson, tmpdir)), repeat), npix, nframes, fmt)
+
+def bench_all(args):
+    res = Results()
+    tmpdir = tempfile.mkdtemp(prefix="lodextract-bench")
+    try:
+        w,h = args.size
+        bench_lod(res, tmpdir, args.repeat, args.members)
+        for fmt in args.formats:
+            bench_def(res, tmpdir, args.repeat, fmt, w, h, args.frames)
+    finally:
+        shutil.rmtree(tmpdir)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"label":args.label, "python":sys.version.split()[0],
+                       "time":time.time(), "results":res.results}, f, indent=4)
+    return True
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="benchmark the extraction and repacking of LOD and DEF files on synthetic data")
+    parser.add_argument("--legacy", action="store_true",
+        help="only compare the DEF frame decoders against the previous implementation")
+    parser.add_argument("--sizes", default="64x64,128x128,256x256,448x400",
+        help="comma separated list of frame sizes for --legacy, widths must be multiples of 32")
+    parser.add_argument("--size", default="256x192",
+        help="size of the synthetic frames, default: %(default)s")
+    parser.add_argument("--frames", type=int, default=32,
+        help="number of frames per synthetic DEF, default: %(default)s")
+    parser.add_argument("--members", type=int, default=2000,
+        help="number of members of the synthetic LOD, default: %(default)s")
+    parser.add_argument("--formats", default="0,1,2,3",
+        help="comma separated list of DEF formats, default: %(default)s")
+    parser.add_argument("--repeat", type=int, default=3,
+        help="number of repetitions, the best time is reported")
+    parser.add_argument("--json", metavar="FILE",
+        help="write the results to FILE for comparison across commits")
+    parser.add_argument("--label", default="",
+        help="label stored with the JSON results, for example a commit id")
+    args = parser.parse_args()
+    if args.legacy:
+        sizes = [tuple(int(v) for v in s.split("x")) for s in args.sizes.split(",")]
+        ret = bench_decode(sizes, args.repeat)
+    else:
+        args.size = tuple(int(v) for v in args.size.split("x"))
+        args.formats = [int(v) for v in args.formats.split(",")]
+        ret = bench_all(args)
+    exit(0 if ret else 1)
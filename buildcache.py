@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2014  Johannes Schauer <j.schauer@email.de>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+# cache for incremental rebuilds of DEF files by makedef
+#
+# encoded frames are stored under a hash of the PNG content, the format, the
+# palette and the encoder options so that only changed frames have to be
+# encoded again
+# for every DEF a manifest records a hash over all its inputs and the size and
+# modification time of the DEF written from them so that unchanged DEFs are
+# not written again at all
+# for DEFs made from RGBA frames the state of the quantizer they were last
+# built with is kept so that the same palette and color mapping can be used
+# again and unchanged frames keep their cache entries
+
+import os
+import struct
+import hashlib
+import json
+import tempfile
+
+# increase whenever the encoders change their output
+version = 2
+
+def file_digest(path):
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1<<16), ''):
+            h.update(chunk)
+    return h.hexdigest()
+
+# write data to path such that parallel readers never see a partial file
+def write_atomic(path, data):
+    fd,tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, "wb") as f:
+        f.write(data)
+    os.rename(tmp, path)
+
+class BuildCache(object):
+    def __init__(self, cachedir):
+        self.cachedir = cachedir
+        self.framedir = os.path.join(cachedir, "frames")
+        if not os.path.isdir(self.framedir):
+            os.makedirs(self.framedir)
+        self.hits = 0
+        self.misses = 0
+
+    # key of a single encoded frame
+    # placement is the position and full size of a cropped frame and its
+    # rectangle in the sheet for frames in an atlas
+    # smallest is the mode of makedef which tries all encodings
+    # quantizer is the digest of the quantizer RGBA frames are mapped with
+    def frame_key(self, digest, fmt, pal, optimal, placement=None, smallest=False,
+                  quantizer=None):
+        h = hashlib.sha1()
+        h.update("%d %s %d %d "%(version,digest,fmt,optimal))
+        if smallest:
+            h.update("smallest ")
+        if quantizer:
+            h.update("quantizer %s "%quantizer)
+        h.update(struct.pack("768B", *pal))
+        if placement:
+            h.update(struct.pack("<%di"%len(placement), *placement))
+        return h.hexdigest()
+
+    # key over all inputs of a DEF, digests are the hashes of all frames in
+    # the order they are stored
+    def def_key(self, in_json, digests, optimal, smallest=False):
+        h = hashlib.sha1()
+        h.update("%d %d "%(version,optimal))
+        if smallest:
+            h.update("smallest ")
+        h.update(json.dumps(in_json, sort_keys=True))
+        for digest in digests:
+            h.update(digest)
+        return h.hexdigest()
+
+    # returns full width and height, margins, width and height, the encoded
+    # data and the format of a frame or None if it is not in the cache
+    def get_frame(self, key):
+        path = os.path.join(self.framedir, key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except IOError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        fw,fh,lm,tm,w,h,fmt = struct.unpack_from("<IIiiIII", data, 0)
+        return fw,fh,lm,tm,w,h,data[28:],fmt
+
+    def put_frame(self, key, fw, fh, lm, tm, w, h, data, fmt):
+        write_atomic(os.path.join(self.framedir, key),
+                     struct.pack("<IIiiIII",fw,fh,lm,tm,w,h,fmt)+str(data))
+
+    # the stored quantizer state of a DEF or None
+    def get_quantizer(self, name):
+        try:
+            with open(os.path.join(self.cachedir, name+".quantizer"), "rb") as f:
+                return f.read()
+        except IOError:
+            return None
+
+    def put_quantizer(self, name, data):
+        write_atomic(os.path.join(self.cachedir, name+".quantizer"), data)
+
+    def _manifest(self, name):
+        return os.path.join(self.cachedir, name+".manifest")
+
+    # a DEF is up to date if its inputs did not change and the DEF written
+    # from them was not touched since
+    def is_up_to_date(self, name, key, outname):
+        try:
+            with open(self._manifest(name)) as f:
+                manifest = json.load(f)
+            st = os.stat(outname)
+        except (IOError, OSError, ValueError):
+            return False
+        return manifest == {"key":key,"size":st.st_size,"mtime":st.st_mtime}
+
+    def update(self, name, key, outname):
+        st = os.stat(outname)
+        write_atomic(self._manifest(name),
+                     json.dumps({"key":key,"size":st.st_size,"mtime":st.st_mtime}))
@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2014  Johannes Schauer <j.schauer@email.de>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+# persistent index of the members of LOD archives and of the groups and
+# frames of DEFs
+#
+# the index is a SQLite database which is filled by lodextract and defextract
+# so that tools which only need to know what is in an archive or a DEF do not
+# have to parse them again
+# loose DEFs which are not part of an archive are recorded with an empty
+# archive name
+
+import os
+import sqlite3
+import defdecode
+
+schema = """
+create table if not exists archives (
+    path text primary key,
+    size integer,
+    mtime real
+);
+create table if not exists members (
+    archive text,
+    name text,
+    offset integer,
+    size integer,
+    csize integer,
+    primary key (archive, name)
+);
+create table if not exists defs (
+    archive text,
+    name text,
+    type integer,
+    format integer,
+    fwidth integer,
+    fheight integer,
+    primary key (archive, name)
+);
+create table if not exists frames (
+    archive text,
+    name text,
+    grp integer,
+    idx integer,
+    offset integer,
+    size integer,
+    format integer,
+    fwidth integer,
+    fheight integer,
+    width integer,
+    height integer,
+    lmargin integer,
+    tmargin integer,
+    primary key (archive, name, grp, idx)
+);
+create index if not exists frames_grp on frames (grp);
+create index if not exists defs_type on defs (type);
+"""
+
+frame_fields = ["grp","idx","offset","size","format","fwidth","fheight",
+                "width","height","lmargin","tmargin"]
+
+# the type, format, full frame size and frame headers of a DEF held in data as
+# recorded by Catalog.add_def_info
+# only the header, the block table and the frame headers are read
+def def_info(data):
+    t,_,offsets = defdecode.parse_header(data)
+    frames = []
+    fmt,fw,fh = -1,0,0
+    for bid,l in offsets.items():
+        for j,offs in enumerate(l):
+            hdr = defdecode.frame_header(data, offs)
+            if fmt == -1:
+                fmt,fw,fh = hdr[1],hdr[2],hdr[3]
+            frames.append((bid,j,offs)+tuple(hdr))
+    return t,fmt,fw,fh,frames
+
+class Catalog(object):
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.row_factory = sqlite3.Row
+        self.db.executescript(schema)
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def commit(self):
+        self.db.commit()
+
+    # an archive is up to date if it was recorded with the same size and
+    # modification time before
+    def is_up_to_date(self, path):
+        st = os.stat(path)
+        row = self.db.execute("select size,mtime from archives where path=?",
+                              (path,)).fetchone()
+        return row is not None and tuple(row) == (st.st_size,st.st_mtime)
+
+    # forget everything recorded for an archive and record its members anew
+    # members is a list of (name,offset,size,csize)
+    def add_archive(self, path, members):
+        st = os.stat(path)
+        for table in ("members","defs","frames"):
+            self.db.execute("delete from %s where archive=?"%table, (path,))
+        self.db.execute("insert or replace into archives values (?,?,?)",
+                        (path,st.st_size,st.st_mtime))
+        self.db.executemany("insert into members values (?,?,?,?,?)",
+                            ((path,)+tuple(m) for m in members))
+
+    # record the type, format and frame headers of a DEF held in data
+    def add_def(self, archive, name, data):
+        self.add_def_info(archive, name, def_info(data))
+
+    # record a DEF from the result of def_info, which worker processes can
+    # compute from the data they already hold
+    def add_def_info(self, archive, name, info):
+        name = name.lower()
+        t,fmt,fw,fh,frames = info
+        self.db.execute("delete from frames where archive=? and name=?", (archive,name))
+        self.db.execute("insert or replace into defs values (?,?,?,?,?,?)",
+                        (archive,name,t,fmt,fw,fh))
+        self.db.executemany("insert into frames values (?,?,?,?,?,?,?,?,?,?,?,?,?)",
+                            ((archive,name)+tuple(f) for f in frames))
+
+    # queries, all return lists of dictionaries
+
+    def _query(self, sql, args=()):
+        return [dict(zip(r.keys(), r)) for r in self.db.execute(sql, args)]
+
+    def archives(self):
+        return self._query("select * from archives order by path")
+
+    # members of an archive or the archive members with the given name
+    def members(self, archive=None, name=None):
+        sql,args = "select * from members where 1",[]
+        if archive is not None:
+            sql += " and archive=?"
+            args.append(archive)
+        if name is not None:
+            sql += " and name=?"
+            args.append(name.lower())
+        return self._query(sql+" order by archive,offset", args)
+
+    # DEFs, optionally only those of the given type or with frames of the
+    # given format
+    # the format recorded for a DEF is the one of its first frame but DEFs
+    # written by makedef --smallest mix formats 0 and 1, so the frames are
+    # searched instead
+    def defs(self, type=None, format=None):
+        sql,args = "select * from defs where 1",[]
+        if type is not None:
+            sql += " and type=?"
+            args.append(type)
+        if format is not None:
+            sql += """ and exists (select 1 from frames where frames.archive=defs.archive
+                and frames.name=defs.name and frames.format=?)"""
+            args.append(format)
+        return self._query(sql+" order by archive,name", args)
+
+    # group ids of a DEF with the number of frames in each
+    def groups(self, name, archive=None):
+        sql,args = "select archive,grp,count(*) as frames from frames where name=?",[name.lower()]
+        if archive is not None:
+            sql += " and archive=?"
+            args.append(archive)
+        return self._query(sql+" group by archive,grp order by archive,grp", args)
+
+    # the frame headers of a DEF
+    def frames(self, name, group=None, archive=None):
+        sql,args = "select * from frames where name=?",[name.lower()]
+        if group is not None:
+            sql += " and grp=?"
+            args.append(group)
+        if archive is not None:
+            sql += " and archive=?"
+            args.append(archive)
+        return self._query(sql+" order by archive,grp,idx", args)
+
+    # DEFs which contain the given group
+    def with_group(self, group):
+        return self._query("""select distinct defs.* from defs join frames
+            on defs.archive=frames.archive and defs.name=frames.name
+            where frames.grp=? order by defs.archive,defs.name""", (group,))
+
+if __name__ == '__main__':
+    import sys
+    import json
+    import argparse
+    parser = argparse.ArgumentParser(
+        usage="%(prog)s index.db [--archives | --members [ARCHIVE] | --defs | --groups DEF | --frames DEF | --with-group GROUP] [--type TYPE] [--format FORMAT]")
+    parser.add_argument("index")
+    parser.add_argument("--archives", action="store_true", help="list recorded archives")
+    parser.add_argument("--members", nargs="?", const="", default=None, metavar="ARCHIVE",
+        help="list the members of all or the given archive")
+    parser.add_argument("--defs", action="store_true", help="list DEFs")
+    parser.add_argument("--groups", metavar="DEF", help="list the groups of a DEF")
+    parser.add_argument("--frames", metavar="DEF", help="list the frames of a DEF")
+    parser.add_argument("--with-group", type=int, metavar="GROUP",
+        help="list the DEFs containing the given group")
+    parser.add_argument("--type", type=int, help="only DEFs of this type")
+    parser.add_argument("--format", type=int, help="only DEFs with frames of this format")
+    args = parser.parse_args()
+    if not os.path.exists(args.index):
+        print "index %s does not exist"%args.index
+        exit(1)
+    with Catalog(args.index) as cat:
+        if args.archives:
+            rows = cat.archives()
+        elif args.members is not None:
+            rows = cat.members(args.members or None)
+        elif args.groups:
+            rows = cat.groups(args.groups)
+        elif args.frames:
+            rows = cat.frames(args.frames)
+        elif args.with_group is not None:
+            rows = cat.with_group(args.with_group)
+        else:
+            rows = cat.defs(args.type, args.format)
+    json.dump(rows, sys.stdout, indent=4, sort_keys=True)
+    sys.stdout.write("\n")
+    exit(0)
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2014  Johannes Schauer <j.schauer@email.de>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+# decoders for the DEF container and the four frame encodings
+#
+# all functions operate on a buffer holding the whole DEF (a string, mmap or
+# memoryview) instead of a file object so that every frame is read once and
+# decoded into a preallocated buffer
+
+import struct
+from collections import defaultdict
+import numpy as np
+
+# return a numpy uint8 view of any buffer without copying it
+def as_array(data):
+    if isinstance(data, np.ndarray):
+        return data
+    if isinstance(data, memoryview):
+        return np.asarray(data)
+    return np.frombuffer(data, dtype=np.uint8)
+
+# parse the DEF header and the block table
+# returns the type, the palette as a flat list of 768 values and a dictionary
+# mapping block ids to lists of frame offsets
+def parse_header(data):
+    # t - type
+    # blocks - # of blocks
+    # the second and third entry are width and height which are not used
+    t,_,_,blocks = struct.unpack_from("<IIII", data, 0)
+    palette = as_array(data)[16:16+768].tolist()
+
+    offsets = defaultdict(list)
+    pos = 16+768
+    for i in xrange(blocks):
+        # bid - block id
+        # entries - number of images in this block
+        # the third and fourth entry have unknown meaning
+        bid,entries,_,_ = struct.unpack_from("<IIII", data, pos)
+        # skip a list of 13 character long filenames
+        pos += 16+13*entries
+        # a list of offsets
+        offsets[bid].extend(struct.unpack_from("<%dI"%entries, data, pos))
+        pos += 4*entries
+    return t,palette,offsets
+
+# the 32 byte header in front of every frame
+# size - size of the frame data following the header
+# fmt - encoding format of image data
+# fw,fh - full width and height
+# w,h - width and height, w must be a multiple of 16
+# lm,tm - left and top margin
+def frame_header(data, offs):
+    return struct.unpack_from("<IIIIIIii", data, offs)
+
+def decode0(blob, w, h, out):
+    n = min(len(blob), w*h)
+    out[:n] = blob[:n]
+
+# the offset of each line is stored as an uint followed by pairs of code and
+# length, code 0xff means raw data, all other codes are a color which is
+# repeated length+1 times
+def decode1(blob, w, h, out):
+    lineoffs = struct.unpack_from("<%dI"%h, blob, 0)
+    for y,pos in enumerate(lineoffs):
+        x = y*w
+        end = x+w
+        while x < end:
+            code = blob[pos]
+            length = min(blob[pos+1]+1, end-x)
+            pos += 2
+            if code == 0xff: # raw data
+                out[x:x+length] = blob[pos:pos+length]
+                pos += length
+            else: # rle
+                out[x:x+length] = chr(code)*length
+            x += length
+
+# decode a stream of segments, each introduced by a byte with a 3 bit code and
+# a 5 bit length, code 7 means raw data, all other codes are a color which is
+# repeated length+1 times
+def decode23segments(blob, pos, out, x, end):
+    while x < end:
+        segment = blob[pos]
+        pos += 1
+        code = segment>>5
+        length = min((segment&0x1f)+1, end-x)
+        if code == 7: # raw data
+            out[x:x+length] = blob[pos:pos+length]
+            pos += length
+        else: # rle
+            out[x:x+length] = chr(code)*length
+        x += length
+
+# the offset of each line is stored as an ushort followed by two bytes of
+# unknown meaning
+def decode2(blob, w, h, out):
+    lineoffs = struct.unpack_from("<%dH"%h, blob, 0)
+    for y,pos in enumerate(lineoffs):
+        decode23segments(blob, pos, out, y*w, (y+1)*w)
+
+# each row is split into 32 byte long blocks which are individually encoded
+# two bytes store the offset for each block per line
+def decode3(blob, w, h, out):
+    lineoffs = struct.unpack_from("<%dH"%((w/32)*h), blob, 0)
+    for i,pos in enumerate(lineoffs):
+        decode23segments(blob, pos, out, i*32, (i+1)*32)
+
+fmtdecoders = [decode0,decode1,decode2,decode3]
+
+# decode the frame at offset offs of the DEF in data
+# returns the frame header and a numpy array of shape (h,w) with the palette
+# indices or None if the frame uses an unknown format
+# format 0 frames are returned as a view of data instead of a copy and must
+# not be used after data was closed or modified
+def decode_frame(data, offs):
+    hdr = frame_header(data, offs)
+    size,fmt,fw,fh,w,h,lm,tm = hdr
+    if fmt >= len(fmtdecoders):
+        print "unknown format: %d"%fmt
+        return hdr,None
+    start = offs+32
+    if fmt == 0 and w != 0 and h != 0 and start+w*h <= len(data):
+        if isinstance(data, (np.ndarray, memoryview)):
+            pixels = as_array(data)[start:start+w*h]
+        else:
+            pixels = np.frombuffer(data, dtype=np.uint8, count=w*h, offset=start)
+        return hdr,pixels.reshape(h,w)
+    out = bytearray(w*h)
+    if w != 0 and h != 0:
+        # some DEFs store a wrong size so fall back to the end of the data
+        end = start+size if size != 0 and start+size <= len(data) else len(data)
+        blob = bytearray(as_array(data)[start:end])
+        fmtdecoders[fmt](blob, w, h, out)
+    return hdr,np.frombuffer(out, dtype=np.uint8).reshape(h,w)
@@ -20,42 +20,167 @@
 # http://aethra-cronicles-remake.googlecode.com/svn-history/r4/trunk/export/sergroj/RSDef.pas
 # vcmi/client/CAnimation.cpp
 
+import mmap
 import struct
-from PIL import Image, ImageDraw
-from collections import defaultdict
+import hashlib
+from PIL import Image
 import os
 import json
 import numpy as np
+import defdecode
+import atlas
+import catalog
+import instrument
 
-def extract_def(infile,outdir):
-    f = open(infile)
-    bn = os.path.basename(infile)
+# map palette indices to RGBA
+# special colors:
+# 0 -> (0,0,0,0)    = full transparency
+# 1 -> (0,0,0,0x40) = shadow border
+# 2 -> ???
+# 3 -> ???
+# 4 -> (0,0,0,0x80) = shadow body
+# 5 -> (0,0,0,0)    = selection highlight, treat as full transparency
+# 6 -> (0,0,0,0x80) = shadow body below selection, treat as shadow body
+# 7 -> (0,0,0,0x40) = shadow border below selection, treat as shadow border
+def rgba_lut(palette):
+    lut = np.empty((256,4), dtype=np.uint8)
+    lut[:,:3] = np.reshape(palette, (256,3))
+    lut[:,3] = 0xff
+    lut[0] = (0,0,0,0)
+    lut[1] = (0,0,0,0x40)
+    lut[4] = (0,0,0,0x80)
+    lut[5] = (0,0,0,0)
+    lut[6] = (0,0,0,0x80)
+    lut[7] = (0,0,0,0x40)
+    return lut
+
+# copy pixels into canvas at the given margins, parts outside of the canvas
+# are clipped
+# if lut is given, the palette indices are looked up in it while copying
+# instead of creating an intermediate RGBA array first
+def paste_frame(canvas, pixels, lm, tm, lut=None):
+    ch,cw = canvas.shape[:2]
+    h,w = pixels.shape[:2]
+    x0,y0 = max(lm,0),max(tm,0)
+    x1,y1 = min(lm+w,cw),min(tm+h,ch)
+    if x1 > x0 and y1 > y0:
+        src = pixels[y0-tm:y1-tm,x0-lm:x1-lm]
+        if lut is None:
+            canvas[y0:y1,x0:x1] = src
+        else:
+            # byte indices are always valid, mode clip skips the extra
+            # buffering numpy does for mode raise
+            np.take(lut, src, axis=0, out=canvas[y0:y1,x0:x1], mode='clip')
+
+# how PNG images are written
+# paletted - write 8 bit images with the palette of the DEF and the
+#            transparency of the special colors in a tRNS chunk instead of RGBA
+# crop - only store the frame itself without its transparent margins, the
+#        margins and the full size are stored in the JSON instead
+# atlas - trim frames to their visible pixels and pack all frames of a DEF
+#         into a few sheets, the JSON stores the rectangle of every frame in
+#         its sheet in addition to the margins and the full size
+# compress_level - zlib compression level from 0 to 9
+# compress_type - zlib strategy, one of the keys of compress_types
+# if compress_level or compress_type are None, the PIL default is used
+class OutputProfile(object):
+    compress_types = {"default":0, "filtered":1, "huffman":2, "rle":3, "fixed":4}
+
+    def __init__(self, paletted=False, crop=False, compress_level=None, compress_type=None,
+                 atlas=False):
+        self.paletted = paletted
+        self.crop = crop
+        self.atlas = atlas
+        self.compress_level = compress_level
+        self.compress_type = compress_type
+
+    def save(self, im, path, **kwargs):
+        if self.compress_level is not None:
+            kwargs["compress_level"] = self.compress_level
+        if self.compress_type is not None:
+            kwargs["compress_type"] = self.compress_types[self.compress_type]
+        im.save(path, "PNG", **kwargs)
+
+profiles = {
+    # what PIL does by default
+    "default": OutputProfile(),
+    # for quick iterations during development
+    "fast": OutputProfile(compress_level=1),
+    # smallest files, cropped 8 bit frames at maximum compression
+    "compact": OutputProfile(paletted=True, crop=True, compress_level=9),
+}
+
+def add_profile_arguments(parser):
+    parser.add_argument("--output-profile", choices=sorted(profiles), default="default",
+        help="preset for how PNG images are written (default: %(default)s)")
+    parser.add_argument("--paletted", action="store_true", default=None,
+        help="write frames as 8 bit images with transparency in a tRNS chunk")
+    parser.add_argument("--crop", action="store_true", default=None,
+        help="write frames without their transparent margins and store the margins in the JSON")
+    parser.add_argument("--atlas", action="store_true", default=None,
+        help="pack the frames of every DEF into a few sheets instead of writing one image per frame")
+    parser.add_argument("--compress-level", type=int, choices=range(10),
+        help="zlib compression level of PNG images")
+    parser.add_argument("--compress-type", choices=sorted(OutputProfile.compress_types),
+        help="zlib strategy of PNG images")
+
+# the profile selected by the arguments added by add_profile_arguments
+def profile_from_args(args):
+    base = profiles[args.output_profile]
+    return OutputProfile(base.paletted if args.paletted is None else args.paletted,
+                         base.crop if args.crop is None else args.crop,
+                         base.compress_level if args.compress_level is None else args.compress_level,
+                         args.compress_type or base.compress_type,
+                         base.atlas if args.atlas is None else args.atlas)
+
+# write a frame or sheet given as palette indices or RGBA values
+# palette is the palette of the DEF as a flat list of 768 values
+def save_frame(profile, frame, lut, palette, outname):
+    with instrument.stage("encode"):
+        _save_frame(profile, frame, lut, palette, outname)
+    instrument.count("bytes_out", os.path.getsize(outname))
+
+def _save_frame(profile, frame, lut, palette, outname):
+    if frame.ndim == 3:
+        profile.save(Image.fromarray(frame, 'RGBA'), outname)
+    elif profile.paletted:
+        # 8 bit images keep the palette of the DEF including the colors of
+        # the special entries, which get the same transparency as in RGBA
+        # images
+        im = Image.fromarray(frame, 'P')
+        im.putpalette(palette)
+        profile.save(im, outname, transparency=lut[:8,3].tostring())
+    else:
+        profile.save(Image.fromarray(lut[frame], 'RGBA'), outname)
+
+# infile is either the path to a DEF, a file-like object or a buffer like a
+# memoryview or mmap holding the DEF, for the latter two name is the filename
+# the output is named after, file objects default to the name of their file
+# if dedup is set, identical frames are only written once and all their
+# entries in the JSON refer to the same PNG
+# if cat is a catalog.Catalog, the DEF headers are recorded in it
+# profile is the OutputProfile the frames are written with
+def extract_def(infile,outdir,name=None,dedup=False,cat=None,profile=profiles["default"]):
+    if isinstance(infile, basestring):
+        with instrument.stage("read"):
+            with open(infile, "rb") as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        instrument.count("bytes_in", len(data))
+        name = infile
+    elif hasattr(infile, "read"):
+        data = infile.read()
+        name = name or getattr(infile, "name", None)
+    else:
+        data = infile
+    if not isinstance(name, basestring):
+        print "a name is required for DEFs which are not read from a file"
+        return False
+    bn = os.path.basename(name)
     bn = os.path.splitext(bn)[0].lower()
 
-    # t - type
-    # blocks - # of blocks
-    # the second and third entry are width and height which are not used
-    t,_,_,blocks = struct.unpack("<IIII", f.read(16))
-
-    palette = []
-    for i in range(256):
-        r,g,b = struct.unpack("<BBB", f.read(3))
-        palette.extend((r,g,b))
-
-    offsets = defaultdict(list)
-    for i in range(blocks):
-        # bid - block id
-        # entries - number of images in this block
-        # the third and fourth entry have unknown meaning
-        bid,entries,_,_ = struct.unpack("<IIII", f.read(16))
-        names=[]
-        # a list of 13 character long filenames
-        for j in range(entries):
-            name, = struct.unpack("13s", f.read(13))
-        # a list of offsets
-        for j in range(entries):
-            offs, = struct.unpack("<I", f.read(4))
-            offsets[bid].append(offs)
+    t,palette,offsets = defdecode.parse_header(data)
+    if cat:
+        cat.add_def("", os.path.basename(name), data)
 
     outpath = os.path.join(outdir,"%s.dir"%bn)
     if os.path.exists(outpath):
@@ -67,20 +192,27 @@ def extract_def(infile,outdir):
 
     out_json = {"sequences":[],"type":t,"format":-1}
 
+    # PNGs written so far by frame offset and by content for dedup
+    by_offset = {}
+    by_content = {}
+    lut = rgba_lut(palette)
+    # which palette indices are not fully transparent in RGBA images
+    opaque = lut[:,3] != 0
+    # trimmed frames and their JSON entries waiting to be packed into sheets
+    pending = []
+    canvas = None
     firstfw,firstfh = -1,-1
     for bid,l in offsets.items():
         frames=[]
         for j,offs in enumerate(l):
-            f.seek(offs)
-            pixeldata = ""
-            # first entry is the size which is unused
-            # fmt - encoding format of image data
-            # fw,fh - full width and height
-            # w,h - width and height, w must be a multiple of 16
-            # lm,tm - left and top margin
-            _,fmt,fw,fh,w,h,lm,tm = struct.unpack("<IIIIIIii", f.read(32))
-            outname = os.path.join(outdir,"%s.dir"%bn,"%02d_%02d.png"%(bid,j))
-            print "writing to %s"%outname
+            relname = os.path.join("%s.dir"%bn,"%02d_%02d.png"%(bid,j))
+            # frames stored at the same offset are identical
+            if dedup and offs in by_offset:
+                frames.append(by_offset[offs])
+                continue
+            with instrument.stage("decode"):
+                (_,fmt,fw,fh,w,h,lm,tm),pixels = defdecode.decode_frame(data, offs)
+            instrument.count("frames")
 
             # SGTWMTA.def and SGTWMTB.def fail here
             # they have inconsistent left and top margins
@@ -108,106 +240,100 @@ def extract_def(infile,outdir):
 
             if out_json["format"] == -1:
                 out_json["format"] = fmt
+            elif set((fmt,out_json["format"])) == set((0,1)):
+                # makedef --smallest mixes raw and run length encoded frames
+                out_json["format"] = 1
             elif out_json["format"] != fmt:
-                print "format %d of this frame does not match of last frame %d"%(fmt,global_fmt)
+                print "format %d of this frame does not match of last frame %d"%(fmt,out_json["format"])
                 return False
 
-            frames.append(os.path.join("%s.dir"%bn,"%02d_%02d.png"%(bid,j)))
-
-            if w != 0 and h != 0:
-                if fmt == 0:
-                    pixeldata = f.read(w*h)
-                elif fmt == 1:
-                    lineoffs = struct.unpack("<"+"I"*h, f.read(4*h))
-                    for lineoff in lineoffs:
-                        f.seek(offs+32+lineoff)
-                        totalrowlength=0
-                        while totalrowlength<w:
-                            code,length = struct.unpack("<BB", f.read(2))
-                            length+=1
-                            if code == 0xff: #raw data
-                                pixeldata += f.read(length)
-                            else: # rle
-                                pixeldata += length*chr(code)
-                            totalrowlength+=length
-                elif fmt == 2:
-                    lineoffs = struct.unpack("<%dH"%h, f.read(2*h))
-                    _,_ = struct.unpack("<BB", f.read(2)) # unknown
-                    for lineoff in lineoffs:
-                        if f.tell() != offs+32+lineoff:
-                            print "unexpected offset: %d, expected %d"%(f.tell(),offs+32+lineoff)
-                            f.seek(offs+32+lineoff)
-                        totalrowlength=0
-                        while totalrowlength<w:
-                            segment, = struct.unpack("<B", f.read(1))
-                            code = segment>>5
-                            length = (segment&0x1f)+1
-                            if code == 7: # raw data
-                                pixeldata += f.read(length)
-                            else: # rle
-                                pixeldata += length*chr(code)
-                            totalrowlength+=length
-                elif fmt == 3:
-                    # each row is split into 32 byte long blocks which are individually encoded
-                    # two bytes store the offset for each block per line 
-                    lineoffs = [struct.unpack("<"+"H"*(w/32), f.read(w/16)) for i in range(h)]
-
-                    for lineoff in lineoffs:
-                        for i in lineoff:
-                            if f.tell() != offs+32+i:
-                                print "unexpected offset: %d, expected %d"%(f.tell(),offs+32+i)
-                                f.seek(offs+32+i)
-                            totalblocklength=0
-                            while totalblocklength<32:
-                                segment, = struct.unpack("<B", f.read(1))
-                                code = segment>>5
-                                length = (segment&0x1f)+1
-                                if code == 7: # raw data
-                                    pixeldata += f.read(length)
-                                else: # rle
-                                    pixeldata += length*chr(code)
-                                totalblocklength+=length
-                else:
-                    print "unknown format: %d"%fmt
-                    return False
-                imp = Image.fromstring('P', (w,h),pixeldata)
-                imp.putpalette(palette)
-                # convert to RGBA
-                imrgb = imp.convert("RGBA")
-                # replace special colors
-                # 0 -> (0,0,0,0)    = full transparency
-                # 1 -> (0,0,0,0x40) = shadow border
-                # 2 -> ???
-                # 3 -> ???
-                # 4 -> (0,0,0,0x80) = shadow body
-                # 5 -> (0,0,0,0)    = selection highlight, treat as full transparency
-                # 6 -> (0,0,0,0x80) = shadow body below selection, treat as shadow body
-                # 7 -> (0,0,0,0x40) = shadow border below selection, treat as shadow border
-                pixrgb = np.array(imrgb)
-                pixp = np.array(imp)
-                pixrgb[pixp == 0] = (0,0,0,0)
-                pixrgb[pixp == 1] = (0,0,0,0x40)
-                pixrgb[pixp == 4] = (0,0,0,0x80)
-                pixrgb[pixp == 5] = (0,0,0,0)
-                pixrgb[pixp == 6] = (0,0,0,0x80)
-                pixrgb[pixp == 7] = (0,0,0,0x40)
-                imrgb = Image.fromarray(pixrgb)
-                im = Image.new('RGBA', (fw,fh), (0,0,0,0))
-                im.paste(imrgb,(lm,tm))
-            else: # either width or height is zero
-                im = Image.new('RGBA', (fw,fh), (0,0,0,0))
-            im.save(outname)
+            if pixels is None:
+                return False
+
+            # frames stored at different offsets can still have the same content
+            if dedup:
+                key = hashlib.sha1(struct.pack("<IIIIii",fw,fh,w,h,lm,tm)+pixels.tostring()).digest()
+                if key in by_content:
+                    by_offset[offs] = by_content[key]
+                    frames.append(by_content[key])
+                    continue
+            if profile.atlas:
+                # the sheet and the rectangle in it are filled in once all
+                # frames are known
+                visible = pixels != 0 if profile.paletted else np.take(opaque, pixels)
+                bl,bt,br,bb = atlas.bbox(visible) or (0,0,0,0)
+                entry = {"x":lm+bl,"y":tm+bt}
+                pending.append((entry,pixels[bt:bb,bl:br]))
+            elif profile.crop:
+                entry = {"file":relname,"x":lm,"y":tm}
+            else:
+                entry = relname
+            if dedup:
+                by_content[key] = by_offset[offs] = entry
+            frames.append(entry)
+            if profile.atlas:
+                continue
+
+            outname = os.path.join(outdir,relname)
+            print "writing to %s"%outname
+            if profile.crop:
+                # empty frames are stored as a single transparent pixel
+                if w == 0 or h == 0:
+                    pixels = np.zeros((1,1), dtype=np.uint8)
+                frame = pixels
+            else:
+                with instrument.stage("convert"):
+                    # the canvas is reused as long as the dimensions stay the same
+                    shape = (fh,fw) if profile.paletted else (fh,fw,4)
+                    if canvas is None or canvas.shape != shape:
+                        canvas = np.zeros(shape, dtype=np.uint8)
+                    else:
+                        canvas.fill(0)
+                    if w != 0 and h != 0:
+                        paste_frame(canvas, pixels, lm, tm, None if profile.paletted else lut)
+                frame = canvas
+            save_frame(profile, frame, lut, palette, outname)
+        if profile.crop or profile.atlas:
+            out_json["width"],out_json["height"] = fw,fh
         out_json["sequences"].append({"group":bid,"frames":frames})
+
+    if profile.atlas:
+        with instrument.stage("convert"):
+            positions,sheets = atlas.pack([sub.shape[::-1] for _,sub in pending])
+            sheets = [np.zeros((h,w), dtype=np.uint8) for w,h in sheets]
+            for (entry,sub),(n,x,y) in zip(pending,positions):
+                h,w = sub.shape
+                sheets[n][y:y+h,x:x+w] = sub
+                entry["file"] = os.path.join("%s.dir"%bn,"atlas_%02d.png"%n)
+                entry["rect"] = [x,y,w,h]
+        for n,sheet in enumerate(sheets):
+            outname = os.path.join(outpath,"atlas_%02d.png"%n)
+            print "writing to %s"%outname
+            save_frame(profile, sheet, lut, palette, outname)
+
+    with instrument.stage("write"):
         with open(os.path.join(outdir,"%s.json"%bn),"w+") as o:
             json.dump(out_json,o,indent=4)
     return True
 
 if __name__ == '__main__':
-    import sys
-    if len(sys.argv) != 3:
-        print "usage: %s input.def ./outdir"%sys.argv[0]
-        print "to process all files:"
-        print "    for f in *.def; do n=`basename $f .def`; mkdir -p defs/$n; %s defextract.py $f defs/$n; done"%sys.argv[0]
-        exit(1)
-    ret = extract_def(sys.argv[1], sys.argv[2])
+    import argparse
+    parser = argparse.ArgumentParser(usage="%(prog)s [--dedup] [--index index.db] [--output-profile PROFILE] [--paletted] [--crop] [--atlas] [--compress-level LEVEL] [--compress-type TYPE] [--stats] [--stats-json FILE] [--profile FILE] input.def ./outdir",
+        epilog="""to process all files:
+    for f in *.def; do n=`basename $f .def`; mkdir -p defs/$n; %(prog)s $f defs/$n; done""",
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("infile", metavar="input.def")
+    parser.add_argument("outdir")
+    parser.add_argument("--dedup", action="store_true",
+        help="write identical frames only once and refer to the same PNG in the JSON")
+    parser.add_argument("--index", metavar="index.db",
+        help="record the DEF headers in this catalog database")
+    add_profile_arguments(parser)
+    instrument.add_arguments(parser)
+    args = parser.parse_args()
+    cat = catalog.Catalog(args.index) if args.index else None
+    ret = instrument.run(args, extract_def, args.infile, args.outdir, dedup=args.dedup, cat=cat,
+                         profile=profile_from_args(args))
+    if cat:
+        cat.close()
     exit(0 if ret else 1)
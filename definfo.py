@@ -16,8 +16,16 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
+import os
+import sys
+import mmap
 import struct
+import json
+import csv
+import multiprocessing
 from collections import defaultdict
+import defdecode
+import lodextract
 
 def sanitize_filename(fname):
     # find the first character outside range [32-126]
@@ -55,9 +63,107 @@ def main(infile):
             s,fmt,fw,fh,w,h,lm,tm = struct.unpack("<IIIIIIii", f.read(32))
             print "frame:\t%d\t%d\t%d\t%d\t%d\t%d\t%d\t%d\t%d"%(j,s,fmt,fw,fh,w,h,lm,tm)
 
+# summary of a DEF only reading its header, block table and frame headers
+def scan_def(data, name):
+    t,_,offsets = defdecode.parse_header(data)
+    formats = set()
+    frames = 0
+    fw,fh,w,h = 0,0,0,0
+    framebytes = 0
+    # identical offsets refer to the same frame data
+    for offs in set(o for l in offsets.values() for o in l):
+        size,fmt,ffw,ffh,fw_,fh_,_,_ = defdecode.frame_header(data, offs)
+        formats.add(fmt)
+        fw,fh = max(fw,ffw),max(fh,ffh)
+        w,h = max(w,fw_),max(h,fh_)
+        framebytes += 32+size
+    return {"name":name, "size":len(data), "type":t, "blocks":len(offsets),
+            "frames":sum(len(l) for l in offsets.values()),
+            "formats":",".join(str(f) for f in sorted(formats)),
+            "fwidth":fw, "fheight":fh, "maxwidth":w, "maxheight":h,
+            "framebytes":framebytes}
+
+# job is either the path of a DEF or a tuple of the path of a LOD archive and
+# the name of a DEF inside it
+def scan_job(job):
+    if isinstance(job, tuple):
+        archive,name = job
+    else:
+        archive,name = "",os.path.basename(job)
+    try:
+        if archive:
+            row = scan_def(lodextract._get_archive(archive).read(name), name)
+        else:
+            with open(job, "rb") as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                row = scan_def(data, name)
+            finally:
+                data.close()
+    except (struct.error, ValueError, IndexError) as e:
+        row = {"name":name, "error":str(e)}
+    row["archive"] = archive
+    return row
+
+fields = ["archive","name","size","type","blocks","frames","formats","fwidth","fheight",
+          "maxwidth","maxheight","framebytes","error"]
+
+# scan all DEFs in the given directories, LOD archives or DEF files and
+# write a table of them as json or csv
+def scan(inputs, out, outformat="json", jobs=1):
+    tasks = []
+    for inp in inputs:
+        if os.path.isdir(inp):
+            tasks.extend(os.path.join(inp,f) for f in sorted(os.listdir(inp))
+                         if f.lower().endswith(".def"))
+        elif inp.lower().endswith((".lod",".pac")):
+            with lodextract.LodArchive(inp) as lod:
+                tasks.extend((inp,n) for n in lod.names() if n.endswith(".def"))
+        else:
+            tasks.append(inp)
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs)
+        try:
+            rows = pool.map(scan_job, tasks, chunksize=32)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        rows = map(scan_job, tasks)
+    if outformat == "csv":
+        writer = csv.DictWriter(out, fields)
+        writer.writeheader()
+        writer.writerows(rows)
+    else:
+        json.dump(rows, out, indent=4, sort_keys=True)
+        out.write("\n")
+    return all("error" not in r for r in rows)
+
+# directories and archives are always scanned, only single DEFs are described
+# in detail
+def is_collection(path):
+    return os.path.isdir(path) or path.lower().endswith((".lod",".pac"))
+
 if __name__ == '__main__':
-    import sys
-    if len(sys.argv) != 2:
-        print "usage: %s input.def"%sys.argv[0]
+    if len(sys.argv) == 2 and not is_collection(sys.argv[1]):
+        main(sys.argv[1])
+        exit(0)
+    import argparse
+    parser = argparse.ArgumentParser(
+        usage="%(prog)s input.def\n       %(prog)s [--scan] [--csv] [-j JOBS] [-o OUT] dir|archive.lod|input.def [...]")
+    parser.add_argument("--scan", action="store_true",
+        help="only read headers and block tables of all DEFs and print a table of them, implied if all inputs are directories or archives")
+    parser.add_argument("--csv", action="store_true",
+        help="print the table as csv instead of json")
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+        help="number of worker processes (default: number of cpus)")
+    parser.add_argument("-o", "--output", help="write the table to this file instead of stdout")
+    parser.add_argument("inputs", nargs="+")
+    args = parser.parse_args()
+    if not args.scan and not all(is_collection(i) for i in args.inputs):
+        parser.print_usage()
         exit(1)
-    main(sys.argv[1])
+    out = open(args.output, "w") if args.output else sys.stdout
+    ret = scan(args.inputs, out, "csv" if args.csv else "json",
+               args.jobs or multiprocessing.cpu_count())
+    exit(0 if ret else 1)
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2014  Johannes Schauer <j.schauer@email.de>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+# in-process cache of decoded DEF frames and palettes
+#
+# a DEF is either the path of a DEF file or a tuple of the path of a LOD
+# archive and the name of a DEF in it
+# entries are keyed by the DEF and the modification time of the file it is
+# read from so that changed files are read again, the parsed header of every
+# DEF and the index buffers of its frames share one memory budget
+# archives are opened by the cache itself and stay open until it is closed as
+# cached frames may point into their mappings
+
+import os
+import mmap
+import numpy as np
+import defdecode
+import defextract
+import lodextract
+import lru
+
+# approximate memory used by a cache entry
+# the data of DEFs which are memory mapped or stored uncompressed in an
+# archive is not held in memory by the cache and does not count
+def entry_size(value):
+    if value[0] == "def":
+        _,data,t,palette,offsets,lut,resident = value
+        return 2048+8*sum(len(l) for l in offsets.values())+resident
+    _,hdr,pixels = value
+    return 64+(pixels.nbytes if pixels is not None else 0)
+
+class FrameCache(object):
+    def __init__(self, maxbytes=64<<20):
+        self.cache = lru.LRUCache(maxbytes, entry_size)
+        self.archives = {}
+
+    # the opened archive at path, archives are opened again when they were
+    # modified, the previous mapping is not closed as cached entries may still
+    # use it and is released together with the last of them
+    def archive(self, path):
+        lod = self.archives.get(path)
+        if lod is None or os.stat(path).st_mtime != lod.mtime:
+            lod = self.archives[path] = lodextract.LodArchive(path)
+        return lod
+
+    # close all archives, the cache must not be used afterwards
+    def close(self):
+        self.cache = None
+        for lod in self.archives.values():
+            lod.close()
+        self.archives.clear()
+
+    # the key of a DEF in the cache, changes whenever the DEF is modified
+    def key(self, source):
+        path = source[0] if isinstance(source, tuple) else source
+        return source,os.stat(path).st_mtime
+
+    # returns the data of a DEF and how much of it is held in memory
+    def _read(self, source):
+        if isinstance(source, tuple):
+            archive,name = source
+            lod = self.archive(archive)
+            data = lod.read(name)
+            return data,(len(data) if lod.info(name)[2] else 0)
+        with open(source, "rb") as f:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ),0
+
+    # the data, type, palette, frame offsets and RGBA lookup table of a DEF
+    def _def(self, key):
+        value = self.cache.get(("def",key))
+        if value is None:
+            data,resident = self._read(key[0])
+            t,palette,offsets = defdecode.parse_header(data)
+            value = ("def",data,t,palette,dict(offsets),defextract.rgba_lut(palette),resident)
+            self.cache.put(("def",key), value)
+        return value[1:]
+
+    def type(self, source):
+        return self._def(self.key(source))[1]
+
+    # the palette as a flat list of 768 values
+    def palette(self, source):
+        return self._def(self.key(source))[2]
+
+    # dictionary of group ids to the number of frames in them
+    def groups(self, source):
+        return dict((bid,len(l)) for bid,l in self._def(self.key(source))[3].items())
+
+    # the frame header and the decoded palette indices of a single frame
+    # the returned array is shared with the cache and must not be modified
+    def frame(self, source, group, index):
+        key = self.key(source)
+        value = self.cache.get(("frame",key,group,index))
+        if value is None:
+            data,_,_,offsets,_,_ = self._def(key)
+            hdr,pixels = defdecode.decode_frame(data, offsets[group][index])
+            if pixels is not None:
+                pixels.flags.writeable = False
+            value = ("frame",hdr,pixels)
+            self.cache.put(("frame",key,group,index), value)
+        return value[1:]
+
+    # the frame as RGBA array on a canvas of the full frame size
+    def render(self, source, group, index):
+        (_,_,fw,fh,w,h,lm,tm),pixels = self.frame(source, group, index)
+        canvas = np.zeros((fh,fw,4), dtype=np.uint8)
+        if pixels is not None and w != 0 and h != 0:
+            lut = self._def(self.key(source))[4]
+            defextract.paste_frame(canvas, pixels, lm, tm, lut)
+        return canvas
+
+    def stats(self):
+        return self.cache.stats()
@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2014  Johannes Schauer <j.schauer@email.de>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+# per stage timing and counters shared by all tools
+#
+# code wraps the stages of its work (read, decompress, decode, convert,
+# encode, compress, write) in "with instrument.stage(name)" and counts bytes
+# and frames
+# with instrument.count(name, n)
+# every process collects into its own global Stats, functions run by a worker
+# pool are wrapped in Tracked so that the stats of the workers are sent back
+# with their results and merged into the stats of the main process
+
+import sys
+import time
+import json
+import cProfile
+from contextlib import contextmanager
+
+# processor time of this process, time.clock has a finer resolution than
+# os.times on unix
+cputime = time.clock
+
+class Stats(object):
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        # name -> [wall time, cpu time, number of calls]
+        self.stages = {}
+        self.counters = {}
+
+    @contextmanager
+    def stage(self, name):
+        wall,cpu = time.time(),cputime()
+        try:
+            yield
+        finally:
+            s = self.stages.setdefault(name, [0.0,0.0,0])
+            s[0] += time.time()-wall
+            s[1] += cputime()-cpu
+            s[2] += 1
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0)+n
+
+    # the collected values as a dictionary which can be sent to another
+    # process and merged there
+    def snapshot(self):
+        return {"stages":dict((k,list(v)) for k,v in self.stages.items()),
+                "counters":dict(self.counters)}
+
+    def merge(self, snap):
+        for name,(wall,cpu,calls) in snap["stages"].items():
+            s = self.stages.setdefault(name, [0.0,0.0,0])
+            s[0] += wall
+            s[1] += cpu
+            s[2] += calls
+        for name,n in snap["counters"].items():
+            self.count(name, n)
+
+    def summary(self, elapsed=None):
+        result = self.snapshot()
+        result["stages"] = dict((k,{"wall":v[0],"cpu":v[1],"calls":v[2]})
+                                for k,v in self.stages.items())
+        if elapsed is not None:
+            result["elapsed"] = elapsed
+        return result
+
+    def report(self, out=sys.stdout, elapsed=None):
+        # stages are summed over all processes, so with a worker pool their
+        # wall times add up to more than the elapsed time
+        out.write("%-12s %10s %10s %8s\n"%("stage","wall [s]","cpu [s]","calls"))
+        for name,(wall,cpu,calls) in sorted(self.stages.items(), key=lambda i: -i[1][0]):
+            out.write("%-12s %10.3f %10.3f %8d\n"%(name,wall,cpu,calls))
+        for name,n in sorted(self.counters.items()):
+            out.write("%-12s %10d\n"%(name,n))
+        if elapsed is not None:
+            out.write("%-12s %10.3f\n"%("elapsed",elapsed))
+
+stats = Stats()
+
+def stage(name):
+    return stats.stage(name)
+
+def count(name, n=1):
+    stats.count(name, n)
+
+# wrapper for functions run by the workers of a pool
+# returns the result of the function together with the stats collected while
+# running it
+class Tracked(object):
+    def __init__(self, func):
+        self.func = func
+
+    def __call__(self, *args):
+        stats.reset()
+        result = self.func(*args)
+        return result,stats.snapshot()
+
+# merge the stats returned by Tracked into the stats of this process and
+# return the plain results
+def untrack(results):
+    plain = []
+    for result,snap in results:
+        stats.merge(snap)
+        plain.append(result)
+    return plain
+
+# like untrack but for iterators of results which are consumed one by one
+def iuntrack(results):
+    for result,snap in results:
+        stats.merge(snap)
+        yield result
+
+def add_arguments(parser):
+    parser.add_argument("--profile", metavar="FILE",
+        help="write cProfile statistics of the main process to FILE for use with pstats")
+    parser.add_argument("--stats", action="store_true",
+        help="print time spent per stage and byte and frame counts")
+    parser.add_argument("--stats-json", metavar="FILE",
+        help="write time spent per stage and byte and frame counts as JSON to FILE")
+
+# run func with the profiling and statistics requested by the arguments added
+# by add_arguments and return its result
+def run(args, func, *fargs, **kwargs):
+    stats.reset()
+    start = time.time()
+    if args.profile:
+        prof = cProfile.Profile()
+        try:
+            result = prof.runcall(func, *fargs, **kwargs)
+        finally:
+            prof.dump_stats(args.profile)
+    else:
+        result = func(*fargs, **kwargs)
+    elapsed = time.time()-start
+    if args.stats:
+        stats.report(elapsed=elapsed)
+    if args.stats_json:
+        with open(args.stats_json, "w") as f:
+            json.dump(stats.summary(elapsed), f, indent=4, sort_keys=True)
+            f.write("\n")
+    return result
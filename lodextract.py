@@ -19,78 +19,314 @@
 import zlib
 import struct
 import os
-from PIL import Image, ImageDraw
-
-def is_pcx(data):
-    size,width,height = struct.unpack("<III",data[:12])
-    return size == width*height or size == width*height*3
-
-def read_pcx(data):
-    size,width,height = struct.unpack("<III",data[:12])
-    if size == width*height:
-        im = Image.fromstring('P', (width,height),data[12:12+width*height])
-        palette = []
-        for i in range(256):
-            offset=12+width*height+i*3
-            r,g,b = struct.unpack("<BBB",data[offset:offset+3])
-            palette.extend((r,g,b))
-        im.putpalette(palette)
-        return im
-    elif size == width*height*3:
-        return Image.fromstring('RGB', (width,height),data[12:])
-    else:
-        return None
+import mmap
+import io
+import time
+import multiprocessing
+import numpy as np
+import defextract
+import catalog
+import pcx
+import instrument
 
-def unpack_lod(infile,outdir):
-    f = open(infile)
+# random access to the members of a LOD archive
+# the archive is memory mapped and its directory is parsed in one go so that
+# members can be retrieved by name without reading the rest of the archive
+# stored members are returned as zero-copy memoryviews into the mapping,
+# compressed members are decompressed on demand
+class LodArchive(object):
+    # the directory starts at offset 92 and consists of 32 byte entries
+    # name - zero terminated filename, the remaining bytes are garbage
+    # offset - absolute position of the member data
+    # size - uncompressed size
+    # type - file type, unused
+    # csize - compressed size or zero if the member is stored uncompressed
+    entry_dtype = np.dtype([("name","S16"),("offset","<u4"),("size","<u4"),
+                            ("type","<u4"),("csize","<u4")])
 
-    header = f.read(4)
-    if header != 'LOD\0':
-        print "not LOD file: %s"%header
-        return False
+    def __init__(self, path):
+        self.path = path
+        self.f = open(path, "rb")
+        self.mtime = os.fstat(self.f.fileno()).st_mtime
+        try:
+            self.mm = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+        except:
+            self.f.close()
+            raise
+        try:
+            header = self.mm[:4]
+            if header != 'LOD\0':
+                raise ValueError("not LOD file: %s"%header)
+            try:
+                total, = struct.unpack_from("<I", self.mm, 8)
+                self.entries = np.frombuffer(self.mm, dtype=self.entry_dtype,
+                                             count=total, offset=92)
+            except (struct.error, ValueError):
+                raise ValueError("truncated LOD file: %s"%path)
+        except:
+            self.mm.close()
+            self.f.close()
+            raise
+        self._index = None
+
+    # the memoryviews of stored members returned by read and read_at point
+    # into the mapping, they must not be used after the archive is closed
+    # python 2 does not track buffers exported by an mmap, so accessing them
+    # afterwards crashes instead of raising an error
+    def close(self):
+        self.entries = None
+        self.mm.close()
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return iter(self.names())
+
+    def __contains__(self, name):
+        return name.lower() in self.index
+
+    @property
+    def index(self):
+        # the name to entry mapping is only built once a member is looked up
+        if self._index is None:
+            self._index = dict((n,i) for i,n in enumerate(self.names()))
+        return self._index
 
-    f.seek(8)
-    total, = struct.unpack("<I", f.read(4))
-    f.seek(92)
-
-    files=[]
-    for i in range(total):
-        filename, = struct.unpack("16s", f.read(16))
-        filename = filename[:filename.index('\0')].lower()
-        offset,size,_,csize = struct.unpack("<IIII", f.read(16))
-        files.append((filename,offset,size,csize))
-
-    for filename,offset,size,csize in files:
-        filename=os.path.join(outdir,filename)
-        print filename
-        f.seek(offset)
+    def names(self):
+        return [n.split('\0',1)[0].lower() for n in self.entries["name"]]
+
+    # return (offset,size,csize) of the member with the given name
+    def info(self, name):
+        e = self.entries[self.index[name.lower()]]
+        return int(e["offset"]),int(e["size"]),int(e["csize"])
+
+    # return the content of a member as a memoryview which is only valid as
+    # long as the archive is open
+    def read(self, name):
+        offset,size,csize = self.info(name)
+        return self.read_at(offset,size,csize)
+
+    def read_at(self, offset, size, csize):
+        instrument.count("bytes_in", csize or size)
         if csize != 0:
-            data = zlib.decompress(f.read(csize))
-        else:
-            data = f.read(size)
-        if is_pcx(data):
-            im = read_pcx(data)
-            if not im:
-                return False
+            with instrument.stage("decompress"):
+                data = zlib.decompress(buffer(self.mm, offset, csize))
+            return memoryview(data)
+        return memoryview(np.frombuffer(self.mm, dtype=np.uint8,
+                                        count=size, offset=offset))
+
+    # return a file-like object for a member which reads from the memoryview
+    # returned by read instead of copying the whole member
+    def open(self, name):
+        return MemberFile(self.read(name))
+
+# read only file-like object over a memoryview
+class MemberFile(io.RawIOBase):
+    def __init__(self, view):
+        self.view = view
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def read(self, n=-1):
+        end = len(self.view) if n is None or n < 0 else min(self.pos+n, len(self.view))
+        data = self.view[self.pos:end].tobytes() if end > self.pos else ''
+        self.pos = max(self.pos, end)
+        return data
+
+    def readall(self):
+        return self.read()
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.pos
+        elif whence == io.SEEK_END:
+            offset += len(self.view)
+        if offset < 0:
+            raise IOError("negative seek position %d"%offset)
+        self.pos = offset
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+# archives opened by the current process, workers of the extraction pool map
+# every archive only once and are only sent offsets instead of member data
+_archives = {}
+
+# archives are opened again when they were modified, the previous mapping is
+# not closed as views of it may still be in use and is released together with
+# the last of them
+def _get_archive(path):
+    lod = _archives.get(path)
+    if lod is None or os.stat(path).st_mtime != lod.mtime:
+        lod = _archives[path] = LodArchive(path)
+    return lod
+
+# close the archives which were opened since the registry held previous,
+# archives which were already open before are kept
+def _close_archives(previous):
+    for path,lod in _archives.items():
+        if previous.get(path) is not lod:
+            lod.close()
+            del _archives[path]
+    _archives.update(previous)
+
+# extract a single member and return the number of bytes written or None on
+# failure together with the catalog.def_info of DEF members if index is set
+# if defs is set, DEF members are handed to defextract directly instead of
+# being written to disk
+# images are written according to the defextract.OutputProfile profile
+def extract_member(job):
+    path,name,offset,size,csize,outdir,defs,profile,index = job
+    view = _get_archive(path).read_at(offset,size,csize)
+    info = None
+    if index and name.endswith(".def"):
+        # the DEF was decompressed for extracting anyway
+        try:
+            info = catalog.def_info(view)
+        except (struct.error, ValueError, IndexError) as e:
+            print "cannot index %s: %s"%(name,e)
+    return _extract_member(view, name, size, outdir, defs, profile),info
+
+def _extract_member(view, name, size, outdir, defs, profile):
+    filename=os.path.join(outdir,name)
+    print filename
+    if defs and name.endswith(".def"):
+        try:
+            if defextract.extract_def(view, outdir, name, profile=profile):
+                return size
+        except (struct.error, ValueError, IndexError) as e:
+            print e
+        # keep DEFs which can't be extracted as they are
+        print "cannot extract %s, writing it unchanged"%name
+    try:
+        if pcx.is_pcx(view):
+            with instrument.stage("convert"):
+                im = pcx.read(view)
+            if im is None:
+                print "cannot read bitmap %s"%name
+                return None
             filename = os.path.splitext(filename)[0]
             filename = filename+".png"
-            im.save(filename)
+            with instrument.stage("encode"):
+                profile.save(im, filename)
         else:
-            with open(filename,"w+") as o:
-                o.write(data)
+            with instrument.stage("write"):
+                with open(filename,"w+") as o:
+                    o.write(view.tobytes())
+            instrument.count("bytes_out", len(view))
+    except IOError as e:
+        print "cannot write %s: %s"%(filename,e)
+        return None
+    return len(view)
 
+# record the members of an archive in the catalog
+# returns False for archives which did not change since they were last
+# recorded, otherwise the headers of their DEFs have to be recorded as well
+def index_lod(cat, infile, lod):
+    if cat.is_up_to_date(infile):
+        return False
+    cat.add_archive(infile, [(n,int(e["offset"]),int(e["size"]),int(e["csize"]))
+                             for n,e in zip(lod.names(),lod.entries)])
     return True
 
+# if index is given, the archive members and DEF headers are recorded in the
+# catalog database at that path, the DEF headers are read by the workers
+# extracting the DEFs
+def unpack_lods(infiles,outdir,jobs=1,defs=False,index=None,
+                profile=defextract.profiles["default"]):
+    tasks = []
+    insize = 0
+    cat = catalog.Catalog(index) if index else None
+    for infile in infiles:
+        try:
+            lod = LodArchive(infile)
+        except ValueError as e:
+            print e
+            if cat:
+                cat.close()
+            return False
+        with lod:
+            indexdefs = index_lod(cat, infile, lod) if cat else False
+            for name,e in zip(lod.names(),lod.entries):
+                offset,size,csize = int(e["offset"]),int(e["size"]),int(e["csize"])
+                tasks.append((infile,name,offset,size,csize,outdir,defs,profile,indexdefs))
+                insize += csize or size
+
+    start = time.time()
+    if jobs == 1:
+        previous = dict(_archives)
+        try:
+            results = map(extract_member, tasks)
+        finally:
+            _close_archives(previous)
+    else:
+        pool = multiprocessing.Pool(jobs)
+        try:
+            results = instrument.untrack(pool.map(instrument.Tracked(extract_member),
+                                                  tasks, chunksize=16))
+        finally:
+            pool.close()
+            pool.join()
+    elapsed = time.time()-start
+
+    if cat:
+        for task,(_,info) in zip(tasks,results):
+            if info:
+                cat.add_def_info(task[0], task[1], info)
+        cat.commit()
+        cat.close()
+    results = [written for written,_ in results]
+    if None in results:
+        return False
+    outsize = sum(results)
+    mb = 1024.0*1024.0
+    print "extracted %d members from %d archives in %.2f s"%(len(tasks),len(infiles),elapsed)
+    print "read %.1f MiB, decompressed %.1f MiB (%.1f MiB/s)"%(insize/mb,outsize/mb,outsize/mb/max(elapsed,1e-6))
+    return True
+
+def unpack_lod(infile,outdir,index=None):
+    return unpack_lods([infile],outdir,index=index)
+
 if __name__ == '__main__':
     import sys
-    if len(sys.argv) != 3:
-        print "usage: %s infile.lod ./outdir"%sys.argv[0]
-        print ""
-        print "usually after installing the normal way:"
-        print "    %s .vcmi/Data/H3bitmap.lod .vcmi/Mods/vcmi/Data/"%sys.argv[0]
-        print "    rm .vcmi/Data/H3bitmap.lod"
-        print "    %s .vcmi/Data/H3sprite.lod .vcmi/Mods/vcmi/Data/"%sys.argv[0]
-        print "    rm .vcmi/Data/H3sprite.lod"
-        exit(1)
-    ret = unpack_lod(sys.argv[1], sys.argv[2])
+    import argparse
+    parser = argparse.ArgumentParser(
+        usage="%(prog)s [-j JOBS] [--defs] [--index index.db] [--output-profile PROFILE] [--paletted] [--crop] [--atlas] [--compress-level LEVEL] [--compress-type TYPE] [--stats] [--stats-json FILE] [--profile FILE] infile.lod [infile.lod ...] ./outdir",
+        epilog="""usually after installing the normal way:
+    %(prog)s .vcmi/Data/H3bitmap.lod .vcmi/Data/H3sprite.lod .vcmi/Mods/vcmi/Data/
+    rm .vcmi/Data/H3bitmap.lod .vcmi/Data/H3sprite.lod""",
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("infiles", nargs="+", metavar="infile.lod")
+    parser.add_argument("outdir")
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+        help="number of worker processes (default: number of cpus)")
+    parser.add_argument("--defs", action="store_true",
+        help="extract DEF members into JSON files and PNG frames instead of writing the DEF files")
+    parser.add_argument("--index", metavar="index.db",
+        help="record archive members and DEF headers in this catalog database")
+    defextract.add_profile_arguments(parser)
+    instrument.add_arguments(parser)
+    args = parser.parse_args()
+    ret = instrument.run(args, unpack_lods, args.infiles, args.outdir,
+                         args.jobs or multiprocessing.cpu_count(),
+                         args.defs, args.index, defextract.profile_from_args(args))
     exit(0 if ret else 1)
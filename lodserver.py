@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2014  Johannes Schauer <j.schauer@email.de>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+# long running HTTP server handing out members of LOD archives and frames of
+# DEFs so that tools do not have to start a new process for every sprite
+#
+# GET /lod/                                 list of archives
+# GET /lod/<archive>/                       list of members of an archive
+# GET /lod/<archive>/<member>               raw member data
+# GET /lod/<archive>/<bitmap>.png           PCX bitmap member as PNG
+# GET /def/<name>/                          type and groups of a DEF
+# GET /def/<name>/<group>/<frame>.png       frame of a DEF as RGBA PNG
+# GET /stats                                cache statistics
+#
+# archives are opened and memory mapped at startup and again when they are
+# modified, DEFs are looked up in the archives in the order they were given
+# and then as loose files in the given directories
+# every request is handled in its own thread and decodes only what it needs,
+# decoded and rendered frames are kept in least recently used caches
+
+import os
+import io
+import json
+import struct
+import zlib
+import urllib
+import BaseHTTPServer
+import SocketServer
+from PIL import Image
+import pcx
+import framecache
+import lru
+
+class ExtractionService(object):
+    def __init__(self, paths, cachebytes=256<<20):
+        # decoded DEFs take a quarter of the budget, rendered frames the rest
+        self.defs = framecache.FrameCache(cachebytes/4)
+        self.frames = lru.LRUCache(cachebytes-cachebytes/4)
+        self.archives = {}
+        self.order = []
+        self.defdirs = []
+        for path in paths:
+            if os.path.isdir(path):
+                self.defdirs.append(path)
+                for fname in sorted(os.listdir(path)):
+                    if fname.lower().endswith((".lod",".pac")):
+                        self.add_archive(os.path.join(path,fname))
+            else:
+                self.add_archive(path)
+
+    # archives are opened by the framecache which also opens them again after
+    # they were modified
+    def add_archive(self, path):
+        name = os.path.basename(path).lower()
+        self.defs.archive(path)
+        self.archives[name] = path
+        self.order.append(name)
+
+    def archive(self, name):
+        path = self.archives.get(name.lower())
+        return self.defs.archive(path) if path else None
+
+    def close(self):
+        self.defs.close()
+        self.archives.clear()
+
+    def member(self, archive, name):
+        lod = self.archive(archive)
+        if lod is None or name not in lod:
+            return None
+        return lod.read(name)
+
+    # the PNG of a PCX bitmap member
+    def bitmap(self, archive, name):
+        lod = self.archive(archive)
+        if lod is None:
+            return None
+        key = ("bitmap",lod.path,lod.mtime,name.lower())
+        png = self.frames.get(key)
+        if png is None:
+            data = self.member(archive, os.path.splitext(name)[0]+".pcx")
+            if data is None:
+                return None
+            im = pcx.read(data)
+            if im is None:
+                return None
+            png = encode_png(im)
+            self.frames.put(key, png)
+        return png
+
+    # returns the DEF of the given name as understood by framecache or None
+    # if there is no DEF of that name
+    def find_def(self, name):
+        name = name.lower()
+        # the name comes from the URL and must not point outside of the
+        # served directories
+        if os.path.isabs(name) or "/" in name or "\\" in name or ".." in name:
+            return None
+        if not name.endswith(".def"):
+            name += ".def"
+        for archive in self.order:
+            if name in self.archive(archive):
+                return (self.archives[archive],name)
+        for defdir in self.defdirs:
+            path = os.path.join(defdir, name)
+            if os.path.isfile(path):
+                return path
+        return None
+
+    def def_info(self, name):
+        source = self.find_def(name)
+        if source is None:
+            return None
+        return {"type":self.defs.type(source),
+                "groups":dict((str(bid),n) for bid,n in self.defs.groups(source).items())}
+
+    # the PNG of a single frame on a canvas of the full frame size
+    # PNGs are keyed like the DEFs in framecache so that they are rendered
+    # again once their DEF was modified
+    def frame(self, name, group, index):
+        source = self.find_def(name)
+        if source is None:
+            return None
+        key = ("frame",self.defs.key(source),group,index)
+        png = self.frames.get(key)
+        if png is not None:
+            return png
+        if not 0 <= index < self.defs.groups(source).get(group, 0):
+            return None
+        png = encode_png(Image.fromarray(self.defs.render(source, group, index), 'RGBA'))
+        self.frames.put(key, png)
+        return png
+
+    def stats(self):
+        return {"defs":self.defs.stats(), "frames":self.frames.stats()}
+
+def encode_png(im):
+    buf = io.BytesIO()
+    im.save(buf, "PNG")
+    return buf.getvalue()
+
+class RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        service = self.server.service
+        parts = [urllib.unquote(p) for p in self.path.split("?",1)[0].split("/")[1:]]
+        try:
+            if parts[0] == "stats":
+                return self.send_json(service.stats())
+            if parts[0] == "lod":
+                if len(parts) == 1 or parts[1] == "":
+                    return self.send_json(service.order)
+                lod = service.archive(parts[1])
+                if lod is None:
+                    return self.send_error(404)
+                if len(parts) == 2 or parts[2] == "":
+                    return self.send_json(lod.names())
+                data = service.member(parts[1], parts[2])
+                if data is not None:
+                    return self.send_data(data.tobytes(), "application/octet-stream")
+                if parts[2].lower().endswith(".png"):
+                    png = service.bitmap(parts[1], parts[2])
+                    if png is not None:
+                        return self.send_data(png, "image/png")
+            elif parts[0] == "def" and len(parts) >= 2:
+                if len(parts) == 2 or parts[2] == "":
+                    info = service.def_info(parts[1])
+                    if info is not None:
+                        return self.send_json(info)
+                elif len(parts) == 4 and parts[3].lower().endswith(".png"):
+                    try:
+                        group,index = int(parts[2]),int(parts[3][:-4])
+                    except ValueError:
+                        return self.send_error(400)
+                    png = service.frame(parts[1], group, index)
+                    if png is not None:
+                        return self.send_data(png, "image/png")
+        # corrupt archives, DEFs and bitmaps
+        except (struct.error, ValueError, IndexError, zlib.error, IOError) as e:
+            return self.send_error(500, str(e))
+        self.send_error(404)
+
+    def send_json(self, obj):
+        self.send_data(json.dumps(obj), "application/json")
+
+    def send_data(self, data, ctype):
+        self.send_response(200)
+        self.send_header("Content-Type", ctype)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+class ExtractionServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, service):
+        BaseHTTPServer.HTTPServer.__init__(self, address, RequestHandler)
+        self.service = service
+
+def serve(paths, host="127.0.0.1", port=8000, cachebytes=256<<20):
+    service = ExtractionService(paths, cachebytes)
+    server = ExtractionServer((host,port), service)
+    print "serving %d archives on http://%s:%d/"%(len(service.order),host,server.server_address[1])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+    return True
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(
+        usage="%(prog)s [--host HOST] [--port PORT] [--cache-mb MB] archive.lod|defdir [...]")
+    parser.add_argument("paths", nargs="+", metavar="archive.lod|defdir",
+        help="LOD archives and directories with LOD archives and DEF files")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--cache-mb", type=int, default=256,
+        help="memory budget for cached DEFs and rendered frames (default: %(default)s)")
+    args = parser.parse_args()
+    ret = serve(args.paths, args.host, args.port, args.cache_mb<<20)
+    exit(0 if ret else 1)
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2014  Johannes Schauer <j.schauer@email.de>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+# least recently used cache with a memory budget
+#
+# the size of every value is determined by the sizeof function given to the
+# cache, the least recently used values are evicted as soon as the sum of all
+# sizes exceeds the budget
+# the cache can be shared between threads
+
+import threading
+from collections import OrderedDict
+
+class LRUCache(object):
+    def __init__(self, maxbytes, sizeof=len):
+        self.maxbytes = maxbytes
+        self.sizeof = sizeof
+        self.items = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value,size = self.items.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            # move to the most recently used end
+            self.items[key] = value,size
+            self.hits += 1
+            return value
+
+    # values larger than the whole budget are not stored at all
+    def put(self, key, value):
+        size = self.sizeof(value)
+        with self.lock:
+            if key in self.items:
+                self.size -= self.items.pop(key)[1]
+            if size > self.maxbytes:
+                return
+            self.items[key] = value,size
+            self.size += size
+            while self.size > self.maxbytes:
+                _,(_,oldsize) = self.items.popitem(last=False)
+                self.size -= oldsize
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.size = 0
+
+    def stats(self):
+        return {"entries":len(self.items), "bytes":self.size, "maxbytes":self.maxbytes,
+                "hits":self.hits, "misses":self.misses}
@@ -18,152 +18,378 @@
 
 import os
 import struct
+import mmap
 import json
+import hashlib
+import zlib
+import itertools
+import multiprocessing
 from collections import defaultdict
 from PIL import Image
 import numpy as np
+import buildcache
+import quantize
+import instrument
+import defdecode
+import lodextract
 
 ushrtmax = (1<<16)-1
 
 def encode0(im):
-    data = ''.join([chr(i) for i in list(im.getdata())])
+    data = np.asarray(im).tostring()
     size = len(data)
     return data,size
 
-# greedy RLE
-# for each pixel, test which encoding manages to encode most data, then apply
-# that encoding and look at the next pixel after the encoded chunk
-def encode1(im):
-    pixels = im.load()
-    w,h = im.size
-    data = []
-    # these function return a tuple of the compressed string and the amount of
-    # pixels compressed
-    def rle_comp(x,y):
-        # find all pixels after the first one with the same color
-        color = pixels[x,y]
-        if color == 0xff:
-            # this color can't be run length encoded
-            return raw_comp(x,y)
+# split the pixels of a frame into runs of the same color
+# a new run is started every blocklen pixels so that no run crosses the
+# boundary of a row (or a block of a row)
+# returns the start position, length and color of every run
+def find_runs(flat, blocklen):
+    newrun = np.ones(len(flat), dtype=bool)
+    newrun[1:] = flat[1:] != flat[:-1]
+    newrun[::blocklen] = True
+    starts = np.flatnonzero(newrun)
+    lengths = np.diff(np.append(starts,len(flat)))
+    return starts,lengths,flat[starts]
+
+# merge consecutive raw runs into one segment unless a new block starts
+# returns the start position, length and the raw flag of every segment
+def merge_raw(starts, raw, blockstart, total):
+    first = np.ones(len(starts), dtype=bool)
+    first[1:] = ~(raw[1:] & raw[:-1])
+    first |= blockstart
+    segstarts = starts[first]
+    seglengths = np.diff(np.append(segstarts,total))
+    return segstarts,seglengths,raw[first]
+
+# choose which runs to store as raw data such that the encoded size is minimal
+# an rle segment costs two bytes per 256 pixels and a raw segment costs two
+# bytes plus one byte per pixel, so consecutive runs are cheaper to store in a
+# single raw segment than to interrupt the raw segment by a short rle run
+# the cost of splitting raw segments longer than 256 pixels is not modelled
+def optimal_raw(lengths, colors, rowstart):
+    n = len(lengths)
+    inf = 1<<62
+    # minimum cost of the runs so far with the last run being rle or raw
+    closed, opened = 0, inf
+    # remember which state the minimum came from for backtracking
+    closed_from_opened = [False]*n
+    opened_from_closed = [False]*n
+    row_from_opened = [False]*n
+    for i in range(n):
+        length = lengths[i]
+        if rowstart[i]:
+            # a raw segment can't continue in the next row
+            row_from_opened[i] = opened < closed
+            closed, opened = min(closed,opened), inf
+        rle = inf if colors[i] == 0xff else 2*((length+255)>>8)
+        closed_from_opened[i] = opened < closed
+        opened_from_closed[i] = closed+2 <= opened
+        closed, opened = min(closed,opened)+rle, min(closed+2,opened)+length
+    raw = [False]*n
+    isopen = opened < closed
+    for i in range(n-1,-1,-1):
+        raw[i] = isopen
+        if isopen:
+            isopen = not opened_from_closed[i]
         else:
-            count = 1
-            for x in range(x+1,w):
-                if pixels[x,y] == color and count < 255:
-                    count += 1
-                else:
-                    break
-            return (struct.pack("<BB", color, count-1), count)
-    def raw_comp(x,y):
-        # read pixels until finding finding two consecutive ones with the same color
-        data = [pixels[x,y]]
-        for x in range(x+1,w):
-            color = pixels[x,y]
-            if color != data[-1] and len(data) < 255:
-                data.append(color)
-            else:
-                break
-        return (struct.pack("<BB%dB"%len(data), 0xff, len(data)-1, *data), len(data))
-    for y in range(h):
-        r = ''
-        x = 0
-        while x < w:
-            rlec, rlel = rle_comp(x, y)
-            rawc, rawl = raw_comp(x, y)
-            # the message that managed to encode more is chosen 
-            if rlel > rawl:
-                r += rlec
-                x += rlel
-            else:
-                r += rawc
-                x += rawl
-        data.append(r)
-    # 4*height bytes for lineoffsets
-    size = 4*h+sum([len(d) for d in data])
-    return data,size
+            isopen = closed_from_opened[i]
+        if rowstart[i] and not isopen:
+            isopen = row_from_opened[i]
+    return np.array(raw, dtype=bool)
 
-def encode23chunk(s,e,pixels,y):
-    r = ''
-    if pixels[s,y] < 8:
-        colors = pixels[s,y]
-        count = 1
+# each row is encoded as pairs of code and length, code 0xff introduces
+# length+1 bytes of raw data, all other codes are a color repeated length+1
+# times
+# runs of at least two pixels are run length encoded and all other pixels are
+# gathered into raw segments unless optimal is set which chooses the
+# segmentation that results in the smallest output
+def encode1(im, optimal=False):
+    pixels = np.asarray(im)
+    h,w = pixels.shape
+    flat = pixels.ravel()
+    starts,lengths,colors = find_runs(flat, w)
+    rowstart = starts%w == 0
+    if optimal:
+        raw = optimal_raw(lengths.tolist(), colors.tolist(), rowstart.tolist())
     else:
-        colors = [pixels[s,y]]
-        count = 0
-    for x in range(s+1,e):
-        color = pixels[x,y]
-        if count > 0:
-            # rle was started
-            if color == colors and count < 32:
-                # same color again, increase count
-                count+=1
+        # color 0xff can't be run length encoded
+        raw = (lengths < 2) | (colors == 0xff)
+    segments = merge_raw(starts, raw, rowstart, w*h)
+    # the data is preceeded by a table of uint offsets of each row
+    r = bytearray(4*h)
+    lineoffs = []
+    data = flat.tostring()
+    for start,length,israw in zip(*[a.tolist() for a in segments]):
+        if start%w == 0:
+            lineoffs.append(len(r))
+        # both segment kinds store at most 256 pixels
+        for s in range(start,start+length,256):
+            n = min(256,start+length-s)
+            if israw:
+                r.append(0xff)
+                r.append(n-1)
+                r += data[s:s+n]
             else:
-                # either new color or maximum length reached, so write current one
-                r+=struct.pack("<B", (colors<<5) | (count-1))
-                if color < 7:
-                    # new rle color
-                    colors = color
-                    count = 1
-                else:
-                    # new non rle color
-                    colors = [color]
-                    count = 0
-        else:
-            # non rle was started
-            if color < 7 or len(colors) > 31:
-                # new rle color, or maximum length reached so write current non rle
-                r+=struct.pack("<B", (7<<5) | (len(colors)-1))
-                r+=struct.pack("<%dB"%len(colors), *colors)
-                if color < 7:
-                    colors = color
-                    count = 1
-                else:
-                    colors = [color]
-                    count = 0
+                r.append(data[s])
+                r.append(n-1)
+    struct.pack_into("<%dI"%h, r, 0, *lineoffs)
+    return r,len(r)
+
+# like optimal_raw but for formats 2 and 3 where only the keys 0-6 can be run
+# length encoded, an rle segment costs one byte per 32 pixels and a raw
+# segment costs one byte per 32 pixels plus one byte per pixel
+# a raw segment is split every 32 pixels, so the state of an open raw segment
+# includes how many pixels its last 32 pixel part already holds
+# state 0 means the last run was rle encoded, state m>0 that it is part of a
+# raw segment whose last part holds m pixels
+def optimal_raw23(lengths, keys, blockstart):
+    n = len(lengths)
+    inf = 1<<62
+    cost = [0]+[inf]*32
+    # the state every state of every run was reached from
+    back = []
+    # the state before a new block was started
+    reset_from = [0]*n
+    for i in range(n):
+        length = lengths[i]
+        if blockstart[i]:
+            # a raw segment can't continue in the next block
+            best = min(range(33), key=cost.__getitem__)
+            reset_from[i] = best
+            cost = [cost[best]]+[inf]*32
+        parts = (length+31)>>5
+        new = [inf]*33
+        prev = [0]*33
+        best = min(range(33), key=cost.__getitem__)
+        if keys[i] < 7:
+            new[0] = cost[best]+parts
+            prev[0] = best
+        for m in range(33):
+            if cost[m] == inf:
+                continue
+            if m == 0:
+                c,fill = cost[0]+length+parts,(length-1)%32+1
+            elif length <= 32-m:
+                c,fill = cost[m]+length,m+length
             else:
-                # new non rle color, so append it to current
-                colors.append(color)
-    # write last color
-    if count > 0:
-        # write rle
-        r+=struct.pack("<B", (colors<<5) | (count-1))
-    else:
-        # write non rle
-        r+=struct.pack("<B", (7<<5) | (len(colors)-1))
-        r+=struct.pack("<%dB"%len(colors), *colors)
-    return r
+                rest = length-(32-m)
+                c,fill = cost[m]+length+((rest+31)>>5),(rest-1)%32+1
+            if c < new[fill]:
+                new[fill] = c
+                prev[fill] = m
+        cost = new
+        back.append(prev)
+    raw = [False]*n
+    state = min(range(33), key=cost.__getitem__)
+    for i in range(n-1,-1,-1):
+        raw[i] = state != 0
+        state = back[i][state]
+        if blockstart[i]:
+            state = reset_from[i]
+    return np.array(raw, dtype=bool)
+
+# formats 2 and 3 encode segments with a single byte of which the upper 3 bits
+# are the color for rle or 7 for raw data and the lower 5 bits the length-1
+# only the special colors 0-6 can be run length encoded so all other colors
+# are gathered in raw segments
+# the pixels are split into blocks of blocklen pixels which are encoded
+# independently and whose offsets are stored in a table of ushorts of
+# tablesize bytes in front of the data
+# everything is computed on whole frames with numpy and written into a single
+# preallocated buffer
+# if optimal is set, short runs of special colors are stored as part of the
+# surrounding raw data if that results in smaller output
+def encode23(pixels, blocklen, tablesize, optimal=False):
+    flat = pixels.ravel()
+    total = len(flat)
+    key = np.where(flat < 7, flat, 7)
+    if optimal:
+        starts,lengths,keys = find_runs(key, blocklen)
+        raw = optimal_raw23(lengths.tolist(), keys.tolist(), (starts%blocklen == 0).tolist())
+        key[np.repeat(raw, lengths)] = 7
+    newseg = np.ones(total, dtype=bool)
+    newseg[1:] = key[1:] != key[:-1]
+    newseg[::blocklen] = True
+    # no segment can be longer than 32 pixels
+    if blocklen > 32:
+        pos = np.arange(total)
+        segstart = np.maximum.accumulate(np.where(newseg, pos, 0))
+        newseg |= (pos-segstart)%32 == 0
+    starts = np.flatnonzero(newseg)
+    lengths = np.diff(np.append(starts,total))
+    codes = key[starts]
+    israw = codes == 7
+    # every segment occupies one byte plus the pixels in case of raw data
+    segsizes = 1+israw*lengths
+    segpos = tablesize+np.cumsum(segsizes)-segsizes
+    offsets = segpos[np.searchsorted(starts, np.arange(0,total,blocklen))]
+    if len(offsets) and offsets[-1] > ushrtmax:
+        print "exceeding max ushort value: %d"%offsets[-1]
+        return None,0
+    out = np.zeros(tablesize+segsizes.sum(), dtype=np.uint8)
+    out[:2*len(offsets)].view("<u2")[:] = offsets
+    out[segpos] = (codes<<5) | (lengths-1)
+    # copy the raw pixels right behind their segment byte
+    rawpix = np.flatnonzero(key == 7)
+    seg = np.cumsum(newseg)-1
+    out[segpos[seg[rawpix]]+1+rawpix-starts[seg[rawpix]]] = flat[rawpix]
+    data = out.tostring()
+    return data,len(data)
 
 # this is like encode3 but a line is not split into 32 pixel chuncks
 # the reason for this might just be that format 2 images are always 32 pixel wide
-def encode2(im):
-    pixels = im.load()
-    w,h = im.size
-    data = []
-    for y in range(h):
-        data.append(encode23chunk(0,w,pixels,y))
-    # 2*height bytes for lineoffsets plus two unknown bytes
-    size = 2*h+2+sum(len(d) for d in data)
-    return data,size
+# the line offsets are followed by two bytes of unknown meaning
+def encode2(im, optimal=False):
+    pixels = np.asarray(im)
+    h,w = pixels.shape
+    return encode23(pixels, w, 2*h+2, optimal)
 
 # this is like encode2 but limited to only encoding blocks of 32 pixels at a time
-def encode3(im):
-    pixels = im.load()
-    w,h = im.size
-    data = []
-    for y in range(h):
-        res = []
-        # encode each row in 32 pixel blocks
-        for i in range(w/32):
-            res.append(encode23chunk(i*32, (i+1)*32, pixels, y))
-        data.append(res)
+def encode3(im, optimal=False):
+    pixels = np.asarray(im)
+    h,w = pixels.shape
     # width/16 bytes per line as offset header
-    size = (w/16)*h+sum(sum([len(e) for e in d]) for d in data)
-    return data,size
+    return encode23(pixels, 32, (w/16)*h, optimal)
 
 fmtencoders = [encode0,encode1,encode2,encode3]
 
-def makedef(infile, outdir):
-    infiles = defaultdict(list)
-    sig = None
+# encode pixels with all encodings the format allows
+# returns the format, data and size of the smallest and the size of the
+# output of the greedy encoder of the format
+# frames of formats 0 and 1 can be mixed in the same DEF, formats 2 and 3 are
+# tried with the greedy and the optimal segmentation
+def encode_smallest(pixels, fmt):
+    if fmt in (0,1):
+        candidates = [(0,)+encode0(pixels),(1,)+encode1(pixels),(1,)+encode1(pixels, True)]
+        greedy = candidates[fmt]
+    else:
+        candidates = [(fmt,)+fmtencoders[fmt](pixels),(fmt,)+fmtencoders[fmt](pixels, True)]
+        greedy = candidates[0]
+    candidates = [c for c in candidates if c[1] is not None]
+    if not candidates:
+        return fmt,None,0,0
+    return min(candidates, key=lambda c: c[2])+(greedy[2],)
+
+# the atlas sheet opened last, atlas frames of the same sheet follow each
+# other so that every sheet is only decoded once per process
+# the sheet is keyed by its path, modification time and size so that it is
+# read again once it was modified
+_sheet = (None,None)
+
+# open the image of a frame
+# placement is None for images of the full frame size or a tuple of the left
+# and top margin and the full width and height of a cropped frame, followed by
+# the rectangle of the frame in its sheet for frames stored in an atlas
+def open_frame(path, placement=None):
+    global _sheet
+    if not placement or len(placement) == 4:
+        return Image.open(path)
+    st = os.stat(path)
+    key = (path,st.st_mtime,st.st_size)
+    if _sheet[0] != key:
+        im = Image.open(path)
+        im.load()
+        _sheet = (key,im)
+    sx,sy,sw,sh = placement[4:]
+    return _sheet[1].crop((sx,sy,sx+sw,sy+sh))
+
+# the histogram of a frame for the quantizer
+def frame_histogram(ref):
+    with instrument.stage("read"):
+        im = open_frame(*ref)
+        im.load()
+    with instrument.stage("convert"):
+        if im.mode != "RGBA":
+            im = im.convert("RGBA")
+        return quantize.histogram(im)
+
+# open a frame and crop it to its bounding box
+# returns full width and height, left and top margin and the cropped image
+def load_frame(path, fmt, placement=None):
+    im = open_frame(path, placement)
+    if placement:
+        x,y,fw,fh = placement[:4]
+    else:
+        x,y = 0,0
+        fw,fh = im.size
+    lm,tm,rm,bm = im.getbbox() or (0,0,0,0)
+    lm,tm,rm,bm = lm+x,tm+y,rm+x,bm+y
+    # format 3 has to have width and lm divisible by 32
+    if fmt == 3 and lm%32 != 0:
+        # shrink lm to the previous multiple of 32
+        lm = (lm/32)*32
+    w,h = rm-lm,bm-tm
+    if fmt == 3 and w%32 != 0:
+        # grow rm to the next multiple of 32
+        w = (((w-1)>>5)+1)<<5
+        rm = lm+w
+    # areas outside of a cropped image are filled with transparency
+    return fw,fh,lm,tm,im.crop((lm-x,tm-y,rm-x,bm-y))
+
+# all frames of a DEF must have the same dimensions and palette
+def frame_sig(fw,fh,im):
+    if im.mode == 'P':
+        return (fw,fh,im.getpalette())
+    elif im.mode == 'RGBA':
+        return (fw,fh,None)
+    else:
+        return None
+
+# optimal chooses the optimal run length encoding of format 1 instead of the
+# greedy one, smallest tries all encodings and keeps the smallest
+# returns the format, width, height, data and size of the frame and the size
+# the greedy encoder of the format produces if smallest is set
+def encode_frame(im, fmt, optimal, smallest=False):
+    # numpy turns an empty PIL image into a 0-d object array, so the size has
+    # to be checked before the conversion
+    w,h = im.size if isinstance(im, Image.Image) else im.shape[::-1]
+    if w == 0 or h == 0:
+        return fmt,0,0,'',0,0
+    pixels = np.asarray(im)
+    if smallest:
+        fmt,data,size,greedy = encode_smallest(pixels, fmt)
+        return fmt,w,h,data,size,greedy
+    if fmt == 1:
+        data,size = encode1(pixels, optimal)
+    else:
+        data,size = fmtencoders[fmt](pixels)
+    return fmt,w,h,data,size,size
+
+# the quantizer used for RGBA input by prepare_frame, worker processes receive
+# it once when they are started
+_quantizer = None
+
+def _init_worker(quantizer):
+    global _quantizer
+    _quantizer = quantizer
+
+# load, check, convert and encode a single frame
+# returns an error message or None and the frame header values, data, format
+# and the size the frame would have with the greedy encoder of the format
+def prepare_frame(task):
+    path,fmt,optimal,smallest,sig,placement = task
+    with instrument.stage("read"):
+        fw,fh,lm,tm,im = load_frame(path, fmt, placement)
+    instrument.count("frames")
+    if fmt == 2 and (fw != 32 or fh != 32):
+        return "format 2 must have width and height 32",None
+    cursig = frame_sig(fw,fh,im)
+    if cursig is None:
+        return "input images must be rgba or palette based",None
+    if sig != cursig:
+        return "sigs must match - got:\n%s\n%s"%(sig,cursig),None
+    if _quantizer and im.size[0] != 0 and im.size[1] != 0:
+        with instrument.stage("convert"):
+            im = _quantizer.quantize(im)
+    with instrument.stage("encode"):
+        ffmt,w,h,data,size,basesize = encode_frame(im, fmt, optimal, smallest)
+    if data is None:
+        return "frame %s could not be encoded"%path,None
+    return None,(fw,fh,lm,tm,w,h,data,ffmt,basesize)
+
+def makedef(infile, outdir, optimal=False, cachedir=None, jobs=1, smallest=False):
+    groups = defaultdict(list)
 
     with open(infile) as f:
         in_json = json.load(f)
@@ -177,126 +403,124 @@ def makedef(infile, outdir):
     outname = os.path.join(outdir,p)+".def"
     print "writing to %s"%outname
 
-    # sanity checks and fill infiles dict
+    # frames are either filenames of images of the full frame size or, for
+    # cropped images, dictionaries of the filename and the margins and, for
+    # frames in an atlas, their rectangle in the sheet
+    # every frame is referred to by a tuple of its path and its placement as
+    # understood by load_frame
     for seq in in_json["sequences"]:
-        bid = seq["group"]
         for f in seq["frames"]:
-            im = Image.open(os.path.join(d,f))
-            fw,fh = im.size
-            if fmt == 2 and (fw != 32 or fh != 32):
-                print "format 2 must have width and height 32"
-                return False
-            lm,tm,rm,bm = im.getbbox() or (0,0,0,0)
-            # format 3 has to have width and lm divisible by 32
-            if fmt == 3 and lm%32 != 0:
-                # shrink lm to the previous multiple of 32
-                lm = (lm/32)*32
-            w,h = rm-lm,bm-tm
-            if fmt == 3 and w%32 != 0:
-                # grow rm to the next multiple of 32
-                w = (((w-1)>>5)+1)<<5
-                rm = lm+w
-            im = im.crop((lm,tm,rm,bm))
-            if im.mode == 'P':
-                cursig =(fw,fh,im.getpalette())
-            elif im.mode == 'RGBA':
-                cursig =(fw,fh,None)
-            else:
-                print "input images must be rgba or palette based"
-                return False
-            if not sig:
-                sig = cursig
+            if isinstance(f, dict):
+                placement = (f["x"],f["y"],in_json["width"],in_json["height"])
+                if "rect" in f:
+                    placement += tuple(f["rect"])
+                ref = (os.path.join(d,f["file"]),placement)
             else:
-                if sig != cursig:
-                    print "sigs must match - got:"
-                    print sig
-                    print cursig
-                    return False
-            infiles[bid].append((lm,tm,im))
-
-    if len(infiles) == 0:
+                ref = (os.path.join(d,f),None)
+            groups[seq["group"]].append(ref)
+
+    refs = [ref for l in groups.values() for ref in l]
+    if len(refs) == 0:
         print "no input files detected"
         return False
+    instrument.count("bytes_in", sum(os.path.getsize(path) for path in set(path for path,_ in refs)))
+
+    cache = None
+    digests = {}
+    if cachedir:
+        cache = buildcache.BuildCache(cachedir)
+        for path,_ in refs:
+            if path not in digests:
+                digests[path] = buildcache.file_digest(path)
+        defkey = cache.def_key(in_json, [digests[path] for path,_ in refs], optimal, smallest)
+        if cache.is_up_to_date(p, defkey, outname):
+            print "%s is up to date"%outname
+            return True
+
+    # the first frame determines the signature all other frames must match
+    path,placement = refs[0]
+    fw,fh,_,_,im = load_frame(path, fmt, placement)
+    sig = frame_sig(fw,fh,im)
+    if not sig:
+        print "input images must be rgba or palette based"
+        return False
 
-    fw,fh,pal = cursig
-    numframes = sum(len(l) for l in infiles.values())
-
-    # input images were RGB, find a good common palette
-    if not pal:
-        # create a concatenation of all images to create a good common palette
-        concatim = Image.new("RGB",(fw,fh*numframes))
-        num = 0
-        for _,l in infiles.items():
-            for _,_,im in l:
-                concatim.paste(im, (0,fh*num))
-                num+=1
-        # convert that concatenation to a palette image to obtain a good common palette
-        concatim = concatim.convert("P", dither=None, colors=248, palette=Image.ADAPTIVE)
-        # concatenate the 248 colors to the 8 special ones
-        pal = [0x00, 0xff, 0xff, # full transparency
-               0xff, 0x96, 0xff, # shadow border
-               0xff, 0x64, 0xff, # ???
-               0xff, 0x32, 0xff, # ???
-               0xff, 0x00, 0xff, # shadow body
-               0xff, 0xff, 0x00, # selection highlight
-               0xb4, 0x00, 0xff, # shadow body below selection
-               0x00, 0xff, 0x00, # shadow border below selection
-               ] + concatim.getpalette()[:744]
-        # convert RGBA images to P images with the common palette
-        for bid,l in infiles.items():
-            newl = []
-            for lm,tm,im in l:
-                w,h = im.size
-                if w == 0 or h == 0:
-                    imp = None
-                else:
-                    # must convert to RGB first for quantize() to work
-                    imrgb = im.convert("RGB")
-                    imp = imrgb.quantize(palette=concatim)
-                    # now shift the colors by 8
-                    pix = np.array(imp)
-                    pix += 8
-                    imp = Image.fromarray(pix)
-                    # now replace full transparency in the original RGBA image with index 0
-                    pixrgba = np.array(im)
-                    alpha = pixrgba[:,:,3]
-                    pix[alpha == 0] = 0
-                    # now replace any half-transpareny with shadow body (index 4)
-                    pix[(alpha > 0) & (alpha < 0xff)] = 4
-                    # TODO: calculate shadow border
-                    # now put the palette with the special colors
-                    imp.putpalette(pal)
-                newl.append((lm,tm,imp))
-            infiles[bid] = newl
-
-    # encode all images according to the required format
-    for bid,l in infiles.items():
-        newl = []
-        for lm,tm,im in l:
-            if im:
-                w,h = im.size
-                data,size = fmtencoders[fmt](im)
+    pool = multiprocessing.Pool(jobs) if jobs > 1 else None
+    try:
+        pal,quantizer,qdigest = sig[2],None,None
+        if not pal:
+            # input images were RGBA, find a good common palette from the
+            # histogram of all frames
+            quantizer = quantize.Quantizer()
+            histograms = instrument.iuntrack(pool.imap_unordered(instrument.Tracked(frame_histogram), refs)) \
+                         if pool else itertools.imap(frame_histogram, refs)
+            for hist in histograms:
+                quantizer.add_histogram(*hist)
+            # the palette of the previous build is kept as long as it covers
+            # all colors, otherwise the indices of all frames would change
+            # whenever a single frame changes
+            previous = cache.get_quantizer(p) if cache else None
+            if previous:
+                try:
+                    previous = quantize.Quantizer.loads(previous)
+                except (struct.error, ValueError, zlib.error):
+                    previous = None
+            if previous and previous.covers(quantizer):
+                quantizer = previous
+                pal = quantizer.palette
             else:
-                w,h = 0,0
-                data,size = '',0
-            newl.append((w,h,lm,tm,data,size))
-        infiles[bid] = newl
+                pal = quantizer.build()
+                if cache:
+                    cache.put_quantizer(p, quantizer.dumps())
+            qdigest = quantizer.digest()
+        if pool:
+            pool.close()
+            pool.join()
+            pool = multiprocessing.Pool(jobs, _init_worker, (quantizer,))
+        else:
+            _init_worker(quantizer)
 
-    outf = open(outname, "w+")
+        ret = False
+        with open(outname, "w+b") as outf:
+            try:
+                ret = write_def(outf, t, fmt, sig, pal, groups, optimal, cache, digests, pool, smallest,
+                                qdigest)
+            finally:
+                # a partially written DEF must not be left behind, neither
+                # after an error nor after an exception
+                if not ret:
+                    outf.close()
+                    os.remove(outname)
+    finally:
+        # frames still being prepared after an error are not needed anymore
+        if pool:
+            pool.terminate()
+            pool.join()
+        _init_worker(None)
+    if ret and cache:
+        cache.update(p, defkey, outname)
+        print "reused %d of %d frames"%(cache.hits,len(refs))
+    return ret
 
+# write the DEF while encoding one frame at a time
+# the frame offsets are not known before the frames are encoded so the block
+# table is written with placeholders which are filled in at the end
+# if a cache is given, frames are looked up by the digest of their file first
+# if a pool is given, frames are prepared by its workers
+# groups map block ids to lists of (path,placement) frame references
+# qdigest is the digest of the quantizer RGBA frames are mapped with
+def write_def(outf, t, fmt, sig, pal, groups, optimal, cache=None, digests=None, pool=None,
+              smallest=False, qdigest=None):
+    fw,fh,_ = sig
     # write the header
     # full width and height are not used and not the same for all frames
     # in some defs, so just putting the last known value
-    outf.write(struct.pack("<IIII", t,fw,fh,len(infiles)))
+    outf.write(struct.pack("<IIII", t,fw,fh,len(groups)))
     # write the palette
     outf.write(struct.pack("768B", *pal))
 
-    # the bid table requires 16 bytes for each bid and 13+4 bytes for each entry
-    bidtablesize = 16*len(infiles)+sum(len(l)*(13+4) for l in infiles.values())
-    # the position after the bid table is the header plus palette plus bid table size 
-    curoffset = 16+768+bidtablesize
-
-    for bid,l in infiles.items():
+    tablepos = {}
+    for bid,l in groups.items():
         # write bid and number of frames
         # the last two values have unknown meaning
         outf.write(struct.pack("<IIII",bid,len(l),0,0))
@@ -304,70 +528,241 @@ def makedef(infile, outdir):
         for i,_ in enumerate(l):
             fn = "%02d_%03d.pcx"%(bid,i)
             outf.write(struct.pack("13s", fn))
-        # write data offsets
-        for w,h,_,_,data,size in l:
-            outf.write(struct.pack("<I",curoffset))
-            # every image occupies size depending on its format plus 32 byte header
-            curoffset += 32+size
-
-    for bid,l in infiles.items():
-        for w,h,lm,tm,data,size in l:
-            # size
-            # format
-            # full width and full height
-            # width and height
-            # left and top margin
-            if fmt == 0:
-                outf.write(struct.pack("<IIIIIIii",size,fmt,fw,fh,w,h,lm,tm))
+        # reserve space for the data offsets
+        tablepos[bid] = outf.tell()
+        outf.write(struct.pack("<%dI"%len(l), *([0]*len(l))))
+
+    # frames found in the cache are written right away, all others are
+    # prepared in order and written as soon as they are ready
+    # frames referring to the same file (or to files with the same content
+    # if the digests are known) are only prepared once
+    frames = []
+    tasks = []
+    seen = set()
+    for bid,l in groups.items():
+        for path,placement in l:
+            ident = digests.get(path) if digests else None
+            ident = ident or os.path.normpath(path)
+            # the same image can be placed at different positions and an
+            # atlas holds many frames
+            if placement:
+                ident = (ident,placement)
+            if ident in seen:
+                frames.append((bid,ident,None,None))
+                continue
+            seen.add(ident)
+            cached,key = None,None
+            if cache:
+                key = cache.frame_key(digests[path], fmt, pal, optimal, placement, smallest, qdigest)
+                cached = cache.get_frame(key)
+                if cached and cached[:2] != sig[:2]:
+                    cached = None
+            if not cached:
+                tasks.append((path,fmt,optimal,smallest,sig,placement))
+            frames.append((bid,ident,key,cached))
+    results = instrument.iuntrack(pool.imap(instrument.Tracked(prepare_frame), tasks)) if pool else \
+              itertools.imap(prepare_frame, tasks)
+
+    # identical frames are only stored once and all their entries in the
+    # block table point to the same data
+    offsets = defaultdict(list)
+    by_ident = {}
+    by_content = {}
+    # sizes of the newly encoded frames and their size with the greedy
+    # encoder for reporting the savings of smallest
+    encoded,greedy = 0,0
+    for bid,ident,key,cached in frames:
+        if ident in by_ident:
+            offsets[bid].append(by_ident[ident])
+            continue
+        if cached:
+            fw,fh,lm,tm,w,h,data,ffmt = cached
+        else:
+            msg,frame = next(results)
+            if msg:
+                print msg
+                return False
+            fw,fh,lm,tm,w,h,data,ffmt,basesize = frame
+            encoded += len(data)
+            greedy += basesize
+            if cache:
+                cache.put_frame(key, fw, fh, lm, tm, w, h, data, ffmt)
+        # size
+        # format
+        # full width and full height
+        # width and height
+        # left and top margin
+        header = struct.pack("<IIIIIIii",len(data),ffmt,fw,fh,w,h,lm,tm)
+        content = hashlib.sha1(header+str(data)).digest()
+        if content not in by_content:
+            by_content[content] = outf.tell()
+            with instrument.stage("write"):
+                outf.write(header)
                 outf.write(data)
-            elif fmt == 1:
-                outf.write(struct.pack("<IIIIIIii",size,fmt,fw,fh,w,h,lm,tm))
-                lineoffs = []
-                acc = 4*h
-                for d in data:
-                    lineoffs.append(acc)
-                    acc += len(d)
-                outf.write(struct.pack("<"+"I"*h, *lineoffs))
-                for i in data:
-                    outf.write(i)
-            elif fmt == 2:
-                outf.write(struct.pack("<IIIIIIii",size,fmt,fw,fh,w,h,lm,tm))
-                lineoffs = []
-                acc = 0
-                for d in data:
-                    offs = acc+2*h+2
-                    if offs > ushrtmax: 
-                        print "exceeding max ushort value: %d"%offs
-                        return False
-                    lineoffs.append(offs)
-                    acc += len(d)
-                outf.write(struct.pack("<%dH"%h, *lineoffs))
-                outf.write(struct.pack("<BB", 0, 0)) # unknown meaning
-                for i in data:
-                    outf.write(i)
-            elif fmt == 3:
-                outf.write(struct.pack("<IIIIIIii",size,fmt,fw,fh,w,h,lm,tm))
-                # store the offsets for all 32 pixel blocks
-                acc = 0
-                lineoffs = []
-                for d in data:
-                    for e in d:
-                        offs = acc+(w/16)*h
-                        if offs > ushrtmax:
-                            print "exceeding max ushort value: %d"%offs
-                            return False
-                        lineoffs.append(offs)
-                        acc += len(e)
-                outf.write(struct.pack("<"+"H"*(w/32)*h, *lineoffs))
-                for d in data: # line
-                    for e in d: # 32 pixel block
-                        outf.write(e)
+        by_ident[ident] = by_content[content]
+        offsets[bid].append(by_content[content])
+
+    if smallest and greedy:
+        print "saved %d of %d bytes of newly encoded frames"%(greedy-encoded,greedy)
+
+    # fill in the data offsets
+    instrument.count("bytes_out", outf.tell())
+    for bid,l in offsets.items():
+        outf.seek(tablepos[bid])
+        outf.write(struct.pack("<%dI"%len(l), *l))
     return True
 
+# the error of frames which cannot be stored in the requested format
+not_applicable = "format not applicable"
+
+# decode every frame of a DEF, encode it again in the given format (or its
+# own) and decode the result, all in memory
+# src is the path of a DEF or a tuple of the path of a LOD archive and the
+# name of a DEF in it
+# returns the name of the DEF and a list of (group,index,format,original
+# size,new size,error) for every distinct frame, error is None if the indices
+# decoded from the new encoding are the same as the original ones and
+# not_applicable if the frame cannot be stored in the requested format
+def verify_def(src, fmt=None, optimal=False, smallest=False):
+    if isinstance(src, tuple):
+        name = src[1]
+        data = lodextract._get_archive(src[0]).read(name)
+    else:
+        name = os.path.basename(src)
+        with open(src, "rb") as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    results = []
+    try:
+        _,_,offsets = defdecode.parse_header(data)
+    except (struct.error, ValueError, IndexError) as e:
+        return name,[(-1,-1,-1,0,0,"cannot parse header: %s"%e)]
+    seen = set()
+    for bid,l in offsets.items():
+        for j,offs in enumerate(l):
+            if offs in seen:
+                continue
+            seen.add(offs)
+            try:
+                with instrument.stage("decode"):
+                    (size,ffmt,fw,fh,w,h,_,_),pixels = defdecode.decode_frame(data, offs)
+            except (struct.error, ValueError, IndexError) as e:
+                results.append((bid,j,-1,0,0,"cannot decode: %s"%e))
+                continue
+            if pixels is None:
+                results.append((bid,j,ffmt,size,0,"unknown format"))
+                continue
+            instrument.count("frames")
+            efmt = ffmt if fmt is None else fmt
+            if w == 0 or h == 0:
+                results.append((bid,j,efmt,size,0,None))
+                continue
+            # the same restrictions as when creating a DEF, the size of such
+            # frames is counted as unchanged
+            if (efmt == 3 and w%32 != 0) or (efmt == 2 and (fw != 32 or fh != 32)):
+                results.append((bid,j,efmt,size,size,not_applicable))
+                continue
+            with instrument.stage("encode"):
+                efmt,_,_,blob,newsize,_ = encode_frame(pixels, efmt, optimal, smallest)
+            if blob is None:
+                results.append((bid,j,efmt,size,0,"cannot be encoded"))
+                continue
+            out = bytearray(w*h)
+            with instrument.stage("decode"):
+                defdecode.fmtdecoders[efmt](bytearray(blob), w, h, out)
+            decoded = np.frombuffer(out, dtype=np.uint8).reshape(h,w)
+            error = None
+            if not np.array_equal(decoded, pixels):
+                error = "%d of %d pixels differ"%(np.count_nonzero(decoded != pixels),w*h)
+            results.append((bid,j,efmt,size,newsize,error))
+    return name,results
+
+def _verify_job(job):
+    src,fmt,optimal,smallest = job
+    return verify_def(src, fmt, optimal, smallest)
+
+# verify all DEFs in the given DEF files, directories and LOD archives in
+# parallel, prints a summary for every DEF and details of every frame which
+# fails or, if verbose is set, of all frames
+# returns whether all frames were reproduced
+def verify(inputs, fmt=None, optimal=False, jobs=1, verbose=False, smallest=False):
+    tasks = []
+    for inp in inputs:
+        if os.path.isdir(inp):
+            tasks.extend(os.path.join(inp,f) for f in sorted(os.listdir(inp))
+                         if f.lower().endswith(".def"))
+        elif inp.lower().endswith((".lod",".pac")):
+            with lodextract.LodArchive(inp) as lod:
+                tasks.extend((inp,n) for n in lod.names() if n.endswith(".def"))
+        else:
+            tasks.append(inp)
+    tasks = [(src,fmt,optimal,smallest) for src in tasks]
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs)
+        try:
+            results = instrument.iuntrack(pool.imap(instrument.Tracked(_verify_job), tasks, chunksize=4))
+            results = list(results)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = map(_verify_job, tasks)
+
+    ok = True
+    total_old,total_new,failed,skipped = 0,0,0,0
+    for name,frames in results:
+        old = sum(f[3] for f in frames)
+        new = sum(f[4] for f in frames)
+        bad = [f for f in frames if f[5] and f[5] != not_applicable]
+        na = len([f for f in frames if f[5] == not_applicable])
+        print "%s: %d frames, %d bytes -> %d bytes (%+d), %d failed, %d not applicable"%(name,len(frames),old,new,new-old,len(bad),na)
+        for bid,j,efmt,size,newsize,error in frames:
+            if (error and error != not_applicable) or verbose:
+                print "  %02d_%02d format %d: %d -> %d (%+d) %s"%(bid,j,efmt,size,newsize,newsize-size,error or "ok")
+        total_old += old
+        total_new += new
+        failed += len(bad)
+        skipped += na
+        ok = ok and not bad
+    print "%d DEFs: %d bytes -> %d bytes (%+d), %d frames failed, %d not applicable"%(len(results),total_old,total_new,total_new-total_old,failed,skipped)
+    return ok
+
 if __name__ == '__main__':
     import sys
-    if len(sys.argv) != 3:
-        print "usage: %s infile.json outdir"%sys.argv[0]
-        exit(1)
-    ret = makedef(sys.argv[1], sys.argv[2])
+    import argparse
+    if "--verify" in sys.argv[1:]:
+        parser = argparse.ArgumentParser(
+            usage="%(prog)s --verify [--format FORMAT] [--optimal] [--smallest] [-j JOBS] [-v] [--stats] [--stats-json FILE] [--profile FILE] input.def|dir|archive.lod [...]")
+        parser.add_argument("--verify", action="store_true",
+            help="re-encode all frames of the given DEFs in memory and compare them to the originals")
+        parser.add_argument("--format", type=int, choices=range(len(fmtencoders)),
+            help="encode frames in this format instead of their own")
+        parser.add_argument("--optimal", action="store_true",
+            help="use the optimal run length encoding for format 1")
+        parser.add_argument("--smallest", action="store_true",
+            help="try all encodings the format allows and keep the smallest")
+        parser.add_argument("-j", "--jobs", type=int, default=None,
+            help="number of worker processes (default: number of cpus)")
+        parser.add_argument("-v", "--verbose", action="store_true",
+            help="print the size of every frame, not only of the failed ones")
+        parser.add_argument("inputs", nargs="+")
+        instrument.add_arguments(parser)
+        args = parser.parse_args()
+        ret = instrument.run(args, verify, args.inputs, args.format, args.optimal,
+                             args.jobs or multiprocessing.cpu_count(), args.verbose, args.smallest)
+        exit(0 if ret else 1)
+    parser = argparse.ArgumentParser(usage="%(prog)s [--optimal] [--smallest] [--cache DIR] [-j JOBS] [--stats] [--stats-json FILE] [--profile FILE] infile.json outdir\n       %(prog)s --verify [options] input.def|dir|archive.lod [...]")
+    parser.add_argument("infile", metavar="infile.json")
+    parser.add_argument("outdir")
+    parser.add_argument("--optimal", action="store_true",
+        help="choose the run length encoding of format 1 that results in the smallest output instead of a greedy one")
+    parser.add_argument("--smallest", action="store_true",
+        help="try all encodings the format allows for every frame and keep the smallest, formats 0 and 1 are mixed")
+    parser.add_argument("--cache", metavar="DIR",
+        help="keep encoded frames in DIR and only encode frames and write DEFs whose input changed")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+        help="number of worker processes converting and encoding frames")
+    instrument.add_arguments(parser)
+    args = parser.parse_args()
+    ret = instrument.run(args, makedef, args.infile, args.outdir, args.optimal, args.cache, args.jobs,
+                         args.smallest)
     exit(0 if ret else 1)
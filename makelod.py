@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2014  Johannes Schauer <j.schauer@email.de>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import os
+import struct
+import zlib
+import time
+import itertools
+import multiprocessing
+from PIL import Image
+import pcx
+import instrument
+
+# read a member from disk, PNG images are converted back to the PCX layout
+# of the game, and compress it
+# returns the member name, the uncompressed and compressed size and the data
+# which is stored uncompressed if csize is zero or an error message
+def pack_member(job):
+    path,level = job
+    name = os.path.basename(path).lower()
+    instrument.count("bytes_in", os.path.getsize(path))
+    if name.endswith(".png"):
+        with instrument.stage("decode"):
+            im = Image.open(path)
+            im.load()
+        with instrument.stage("convert"):
+            if im.mode not in ('P','RGB'):
+                # the game has no use for transparency in bitmaps
+                im = im.convert('RGB')
+            data = pcx.write(im)
+        name = os.path.splitext(name)[0]+".pcx"
+    else:
+        with instrument.stage("read"):
+            with open(path, "rb") as f:
+                data = f.read()
+    # names are stored zero terminated in 16 bytes
+    if len(name) > 15:
+        return "filename too long: %s"%name
+    size,csize = len(data),0
+    if level > 0:
+        with instrument.stage("compress"):
+            cdata = zlib.compress(data, level)
+        # store members uncompressed if compression doesn't help
+        if len(cdata) < size:
+            data,csize = cdata,len(cdata)
+    return name,size,csize,data
+
+def pack_lod(infiles, outfile, level=9, jobs=1):
+    paths = []
+    for infile in infiles:
+        if os.path.isdir(infile):
+            paths.extend(os.path.join(infile,f) for f in sorted(os.listdir(infile))
+                         if os.path.isfile(os.path.join(infile,f)))
+        else:
+            paths.append(infile)
+    if len(paths) == 0:
+        print "no input files detected"
+        return False
+
+    print "writing to %s"%outfile
+    start = time.time()
+    pool = multiprocessing.Pool(jobs) if jobs > 1 else None
+    try:
+        with open(outfile, "w+b") as outf:
+            ret = write_lod(outf, paths, level, pool)
+    finally:
+        if pool:
+            pool.terminate()
+            pool.join()
+    if not ret:
+        os.remove(outfile)
+        return False
+    elapsed = time.time()-start
+    print "packed %d members in %.2f s"%(len(paths),elapsed)
+    return True
+
+# the directory is written after all members are compressed and their sizes
+# are known
+def write_lod(outf, paths, level, pool):
+    # the header is followed by the number of members and 80 bytes of unknown
+    # meaning, the 200 is the value found in the archives of the base game
+    outf.write(struct.pack("<4sII80x", "LOD\0", 200, len(paths)))
+    # reserve 32 bytes per directory entry
+    outf.write("\0"*32*len(paths))
+
+    jobs = [(path,level) for path in paths]
+    results = instrument.iuntrack(pool.imap(instrument.Tracked(pack_member), jobs, chunksize=8)) \
+              if pool else itertools.imap(pack_member, jobs)
+    names = set()
+    entries = []
+    for path,result in itertools.izip(paths, results):
+        if isinstance(result, str):
+            print result
+            return False
+        name,size,csize,data = result
+        if name in names:
+            print "duplicate member: %s"%name
+            return False
+        names.add(name)
+        print name
+        # the fourth value is the file type which is unused
+        entries.append(struct.pack("<16sIIII", name, outf.tell(), size, 0, csize))
+        with instrument.stage("write"):
+            outf.write(data)
+
+    instrument.count("bytes_out", outf.tell())
+    outf.seek(92)
+    outf.write(''.join(entries))
+    return True
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(
+        usage="%(prog)s [-j JOBS] [-l LEVEL] [--stats] [--stats-json FILE] [--profile FILE] outfile.lod infile|indir [...]",
+        description="pack files into a LOD archive, PNG images are converted to the PCX layout used by the game")
+    parser.add_argument("outfile", metavar="outfile.lod")
+    parser.add_argument("infiles", nargs="+", metavar="infile|indir")
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+        help="number of worker processes (default: number of cpus)")
+    parser.add_argument("-l", "--level", type=int, default=9, choices=range(10),
+        help="zlib compression level, 0 stores all members uncompressed (default: %(default)s)")
+    instrument.add_arguments(parser)
+    args = parser.parse_args()
+    ret = instrument.run(args, pack_lod, args.infiles, args.outfile, args.level,
+                         args.jobs or multiprocessing.cpu_count())
+    exit(0 if ret else 1)
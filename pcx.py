@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2014  Johannes Schauer <j.schauer@email.de>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+# the bitmap format of the .pcx members of LOD archives
+#
+# despite the extension these are not ZSoft PCX files but a 12 byte header
+# followed by the uncompressed pixels
+# size - number of bytes of pixel data
+# width
+# height
+# if size is width*height the pixels are palette indices followed by a palette
+# of 256 RGB entries, if size is width*height*3 the pixels are RGB triples
+#
+# members are parsed as numpy views of the buffer they are read from, so no
+# pixel or palette data is copied
+
+import struct
+import numpy as np
+from PIL import Image
+import defdecode
+
+# returns size, width and height or None if the data is too short
+def header(data):
+    arr = defdecode.as_array(data)
+    if len(arr) < 12:
+        return None
+    return tuple(int(v) for v in arr[:12].view("<u4"))
+
+def is_pcx(data):
+    arr = defdecode.as_array(data)
+    hdr = header(arr)
+    if hdr is None:
+        return False
+    size,width,height = hdr
+    if size == 0:
+        return False
+    if size == width*height:
+        return len(arr) >= 12+size+768
+    return size == width*height*3 and len(arr) >= 12+size
+
+# returns the pixels as an array of shape (h,w) of palette indices or (h,w,3)
+# of RGB values and the palette as an array of shape (256,3) or None
+# the arrays are read only views of data
+def parse(data):
+    if not is_pcx(data):
+        return None,None
+    arr = defdecode.as_array(data)
+    size,width,height = header(arr)
+    pixels = arr[12:12+size]
+    if size == width*height:
+        palette = arr[12+size:12+size+768].reshape(256,3)
+        return pixels.reshape(height,width),palette
+    return pixels.reshape(height,width,3),None
+
+# returns a P or RGB image or None if data is not a bitmap
+def read(data):
+    pixels,palette = parse(data)
+    if pixels is None:
+        return None
+    height,width = pixels.shape[:2]
+    if palette is None:
+        return Image.frombuffer('RGB', (width,height), pixels, 'raw', 'RGB', 0, 1)
+    im = Image.frombuffer('P', (width,height), pixels, 'raw', 'P', 0, 1)
+    im.putpalette(palette.tobytes())
+    return im
+
+# the inverse of parse, palette is required for arrays of palette indices and
+# is padded to 256 entries
+def encode(pixels, palette=None):
+    pixels = np.ascontiguousarray(pixels, dtype=np.uint8)
+    height,width = pixels.shape[:2]
+    parts = [struct.pack("<III",pixels.size,width,height),pixels.tobytes()]
+    if pixels.ndim == 2:
+        palette = np.asarray(palette, dtype=np.uint8).ravel()[:768]
+        parts.extend((palette.tobytes(),"\0"*(768-len(palette))))
+    return "".join(parts)
+
+# the inverse of read, returns None for images which are neither P nor RGB
+def write(im):
+    w,h = im.size
+    if im.mode == 'P':
+        pixels = np.frombuffer(im.tobytes(), dtype=np.uint8).reshape(h,w)
+        return encode(pixels, im.getpalette())
+    elif im.mode == 'RGB':
+        return encode(np.frombuffer(im.tobytes(), dtype=np.uint8).reshape(h,w,3))
+    else:
+        return None
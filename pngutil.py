@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2014  Johannes Schauer <j.schauer@email.de>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+# direct manipulation of PNG chunks
+#
+# changing the palette of a paletted PNG only requires replacing its PLTE
+# chunk, the compressed pixel data can be copied unchanged instead of being
+# decoded and encoded again
+
+import struct
+import zlib
+
+signature = '\x89PNG\r\n\x1a\n'
+
+# split PNG data into a list of (type,data) tuples
+def chunks(data):
+    if data[:8] != signature:
+        raise ValueError("not a PNG file")
+    result = []
+    pos = 8
+    while pos < len(data):
+        length,ctype = struct.unpack_from(">I4s", data, pos)
+        result.append((ctype, data[pos+8:pos+8+length]))
+        pos += 12+length
+        if ctype == 'IEND':
+            break
+    return result
+
+# serialize a chunk including its length and CRC
+def chunk(ctype, cdata):
+    crc = zlib.crc32(ctype+cdata) & 0xffffffff
+    return struct.pack(">I4s", len(cdata), ctype)+cdata+struct.pack(">I", crc)
+
+def join(chunklist):
+    return signature+''.join(chunk(t,d) for t,d in chunklist)
+
+# width, height, bit depth and color type from the IHDR chunk which comes
+# first in every PNG
+def header(chunklist):
+    ctype,cdata = chunklist[0]
+    if ctype != 'IHDR':
+        raise ValueError("PNG does not start with IHDR")
+    return struct.unpack(">IIBB", cdata[:10])
+
+# the palette of PNG data as a flat list of RGB values or None if the PNG has
+# no palette
+def palette(data):
+    for ctype,cdata in chunks(data):
+        if ctype == 'PLTE':
+            return list(bytearray(cdata))
+    return None
+
+# return the PNG data with its PLTE chunk replaced by the given flat list of
+# RGB values or None if the PNG has no palette
+# the palette is cut to the 2**bitdepth entries images with less than 8 bits
+# per pixel can have
+def replace_palette(data, palette):
+    result = chunks(data)
+    _,_,bitdepth,_ = header(result)
+    palette = palette[:3<<bitdepth]
+    for i,(ctype,_) in enumerate(result):
+        if ctype == 'PLTE':
+            result[i] = ('PLTE', struct.pack("%dB"%len(palette), *palette))
+            return join(result)
+    return None
@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2014  Johannes Schauer <j.schauer@email.de>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+# conversion of RGBA frames to the 8 special colors plus a common palette
+#
+# the histogram of all frames is accumulated one frame at a time, a palette
+# is computed from it by median cut and frames are then mapped to palette
+# indices through a lookup table indexed by the color reduced to 6 bits per
+# channel
+# the state of a built quantizer can be stored and restored so that repacking
+# a DEF keeps mapping its colors to the same indices as long as the palette
+# still covers them
+
+import struct
+import zlib
+import hashlib
+import numpy as np
+
+bits = 6
+nbins = 1<<(3*bits)
+
+# the 8 special colors which are put in front of the palette
+specialpal = [0x00, 0xff, 0xff, # full transparency
+              0xff, 0x96, 0xff, # shadow border
+              0xff, 0x64, 0xff, # ???
+              0xff, 0x32, 0xff, # ???
+              0xff, 0x00, 0xff, # shadow body
+              0xff, 0xff, 0x00, # selection highlight
+              0xb4, 0x00, 0xff, # shadow body below selection
+              0x00, 0xff, 0x00, # shadow border below selection
+              ]
+
+# index of the histogram bin of each color
+def color_bins(rgb):
+    rgb = rgb.astype(np.int64)>>(8-bits)
+    return (rgb[...,0]<<(2*bits)) | (rgb[...,1]<<bits) | rgb[...,2]
+
+# sparse histogram of the opaque pixels of an RGBA image
+# returns the occupied bins, their pixel count and the sum of the colors of
+# the pixels in every bin so that the exact mean can be computed later
+def histogram(im):
+    # numpy turns an empty PIL image into a 0-d object array
+    if im.size[0] == 0 or im.size[1] == 0:
+        return np.zeros(0, dtype=np.int64),np.zeros(0, dtype=np.int64),np.zeros((0,3))
+    px = np.asarray(im)
+    rgb = px[px[:,:,3] == 0xff][:,:3]
+    bins,inverse = np.unique(color_bins(rgb), return_inverse=True)
+    counts = np.bincount(inverse, minlength=len(bins))
+    sums = np.zeros((len(bins),3))
+    for c in range(3):
+        sums[:,c] = np.bincount(inverse, weights=rgb[:,c], minlength=len(bins))
+    return bins,counts,sums
+
+class Quantizer(object):
+    def __init__(self):
+        self.counts = np.zeros(nbins, dtype=np.int64)
+        self.sums = np.zeros((nbins,3))
+        self.colors = None
+        self.lut = None
+        self.palette = None
+
+    def add(self, im):
+        self.add_histogram(*histogram(im))
+
+    def add_histogram(self, bins, counts, sums):
+        self.counts[bins] += counts
+        self.sums[bins] += sums
+
+    # compute up to ncolors colors by median cut over the accumulated
+    # histogram, the histogram is discarded afterwards
+    # returns the palette including the special colors as a flat list
+    def build(self, ncolors=248):
+        occupied = np.flatnonzero(self.counts)
+        weights = self.counts[occupied]
+        sums = self.sums[occupied]
+        means = sums/weights[:,None]
+
+        # split the box with the largest weighted extent along its longest
+        # side at the weighted median until there are enough boxes
+        def score(box):
+            if len(box) < 2:
+                return -1
+            extent = means[box].max(axis=0)-means[box].min(axis=0)
+            return extent.max()*weights[box].sum()
+        boxes = [np.arange(len(occupied))] if len(occupied) else []
+        scores = [score(b) for b in boxes]
+        while len(boxes) < ncolors and scores and max(scores) > 0:
+            i = int(np.argmax(scores))
+            box = boxes.pop(i)
+            scores.pop(i)
+            channel = np.argmax(means[box].max(axis=0)-means[box].min(axis=0))
+            box = box[np.argsort(means[box,channel], kind="mergesort")]
+            acc = np.cumsum(weights[box])
+            cut = min(max(np.searchsorted(acc, acc[-1]/2.0)+1, 1), len(box)-1)
+            for b in (box[:cut], box[cut:]):
+                boxes.append(b)
+                scores.append(score(b))
+
+        colors = np.zeros((ncolors,3))
+        for i,b in enumerate(boxes):
+            colors[i] = sums[b].sum(axis=0)/weights[b].sum()
+        self.colors = np.clip(np.round(colors), 0, 255)[:max(len(boxes),1)]
+        self.lut = np.zeros(nbins, dtype=np.uint8)
+        self.known = np.zeros(nbins, dtype=bool)
+        self._fill(occupied, means)
+        self.counts = self.sums = None
+        self.palette = specialpal + colors.clip(0,255).round().astype(int).ravel().tolist()
+        return self.palette
+
+    # whether every color of the histogram accumulated by other is already
+    # assigned a palette color by this built quantizer
+    def covers(self, other):
+        return bool(self.known[np.flatnonzero(other.counts)].all())
+
+    # hash over everything which determines the indices returned by quantize,
+    # must be taken before the first call to quantize
+    def digest(self):
+        h = hashlib.sha1()
+        h.update(self.colors.tobytes())
+        h.update(self.lut.tobytes())
+        h.update(self.known.tobytes())
+        return h.hexdigest()
+
+    # the state of a built quantizer as a string
+    def dumps(self):
+        return zlib.compress(struct.pack("<I", len(self.colors))+
+                             self.colors.astype("<f8").tobytes()+
+                             struct.pack("768B", *self.palette)+
+                             self.lut.tobytes()+
+                             np.packbits(self.known).tobytes())
+
+    # the built quantizer stored by dumps
+    @classmethod
+    def loads(cls, data):
+        data = zlib.decompress(data)
+        n, = struct.unpack_from("<I", data, 0)
+        q = cls()
+        q.counts = q.sums = None
+        pos = 4
+        q.colors = np.frombuffer(data, dtype="<f8", count=3*n, offset=pos).reshape(n,3).astype(float)
+        pos += 24*n
+        q.palette = list(struct.unpack_from("768B", data, pos))
+        pos += 768
+        q.lut = np.frombuffer(data, dtype=np.uint8, count=nbins, offset=pos).copy()
+        pos += nbins
+        q.known = np.unpackbits(np.frombuffer(data, dtype=np.uint8, count=nbins/8, offset=pos)).astype(bool)
+        return q
+
+    # assign the nearest palette color to the given bins
+    def _fill(self, bins, means):
+        for i in range(0, len(bins), 4096):
+            m = means[i:i+4096]
+            dist = ((m[:,None,:]-self.colors[None,:,:])**2).sum(axis=2)
+            self.lut[bins[i:i+4096]] = dist.argmin(axis=1)
+        self.known[bins] = True
+
+    # map an RGBA image to palette indices
+    # returns a numpy array of the same size
+    def quantize(self, im):
+        px = np.asarray(im)
+        idx = color_bins(px[:,:,:3])
+        # colors which were not part of the histogram use the center of
+        # their bin
+        missing = np.unique(idx[~self.known[idx]])
+        if len(missing):
+            centers = np.empty((len(missing),3))
+            mask = (1<<bits)-1
+            for c,shift in enumerate((2*bits,bits,0)):
+                centers[:,c] = (((missing>>shift)&mask)<<(8-bits)) + (1<<(7-bits))
+            self._fill(missing, centers)
+        # the regular colors start after the 8 special ones
+        pix = self.lut[idx]+8
+        # now replace full transparency with index 0
+        alpha = px[:,:,3]
+        pix[alpha == 0] = 0
+        # the extraction writes shadow border (index 1) with an alpha of 0x40
+        # and shadow body (index 4) with an alpha of 0x80, so any other
+        # half-transparency is mapped to whichever is closer
+        pix[(alpha > 0) & (alpha < 0x60)] = 1
+        pix[(alpha >= 0x60) & (alpha < 0xff)] = 4
+        return pix
@@ -1,50 +1,145 @@
 #!/usr/bin/env python
 
-import numpy as np
 from PIL import Image
+import numpy as np
 import crcmod
 import os
+import io
+import time
+import multiprocessing
+import pngutil
+import instrument
 
 crc24_func = crcmod.mkCrcFun(0x1864CFBL) # polynomial from libgcrypt
 
+# keep the special colors and map all other palette indices to 255
+shred_lut = np.array(range(8)+[255]*248, dtype=np.uint8)
+
 def handle_img(inf, color):
-    with open(inf) as f:
-        im = Image.open(f)
-        pal = im.getpalette()
-        pixels = np.array(im)
-    if pal:
+    with instrument.stage("read"):
+        with open(inf, "rb") as f:
+            data = f.read()
+    instrument.count("bytes_in", len(data))
+    instrument.count("frames")
+    # opening only reads the header, the pixel data is only decoded if it can
+    # hold indices which have to be clamped
+    im = Image.open(io.BytesIO(data))
+    if im.mode == 'P':
+        orig = pngutil.palette(data)
+        pal = orig+[0]*(768-len(orig))
         pal[765], pal[766], pal[767] = color
-        pixels[pixels > 7] = 255
-        im = Image.fromarray(pixels)
-        im.putpalette(pal)
+        # images with no more palette entries than special colors have no
+        # index to clamp
+        if len(orig) > 24:
+            with instrument.stage("decode"):
+                pixels = np.array(im)
+            if ((pixels > 7) & (pixels != 255)).any():
+                with instrument.stage("convert"):
+                    # remap the decoded indices in place and hand the same
+                    # buffer back to PIL
+                    np.take(shred_lut, pixels, out=pixels)
+                    out = Image.frombuffer('P', im.size, pixels, 'raw', 'P', 0, 1)
+                    out.putpalette(pal)
+                with instrument.stage("encode"):
+                    out.save(inf)
+                instrument.count("bytes_out", os.path.getsize(inf))
+                return
+        # only the palette changes, so the compressed pixel data is kept and
+        # only the PLTE chunk is written anew
+        with instrument.stage("convert"):
+            new = pngutil.replace_palette(data, pal)
+        if new == data:
+            return
+        data = new
     else:
-        # non-palette pictures have no transparency
-        im = Image.new('RGB', im.size, color)
-        # in case we ever want to replace colors in rgb images: 
-        #rc, gc, bc = pixels[:,:,0], pixels[:,:,1], pixels[:,:,2]
-        #mask = (rc == 0) & (gc == 255) & (bc == 255)
-        #pixels[:,:,:3][mask] = color
-    im.save(inf)
+        with instrument.stage("encode"):
+            # non-palette pictures have no transparency and only their size
+            # is needed, so their pixel data is never decoded
+            im = Image.new('RGB', im.size, color)
+            # in case we ever want to replace colors in rgb images:
+            #rc, gc, bc = pixels[:,:,0], pixels[:,:,1], pixels[:,:,2]
+            #mask = (rc == 0) & (gc == 255) & (bc == 255)
+            #pixels[:,:,:3][mask] = color
+            buf = io.BytesIO()
+            im.save(buf, "PNG")
+            data = buf.getvalue()
+    with instrument.stage("write"):
+        with open(inf, "wb") as f:
+            f.write(data)
+    instrument.count("bytes_out", len(data))
 
-def main(inf):
-    print "processing %s"%inf
+# the color of a bitmap or a *.dir directory is derived from its path
+def target_color(inf):
     crc = crc24_func(inf)
     r = crc>>16
     g = (crc&0xff00)>>8
     b = crc&0xff
-    color = r%255,g%255,b%255 # avoid hitting special values
+    return r%255,g%255,b%255 # avoid hitting special values
+
+# return (image,color) tuples for all images of a target
+def target_tasks(inf):
+    color = target_color(inf)
     if os.path.isdir(inf):
-        for fname in os.listdir(inf):
-            fname = os.path.join(inf,fname)
-            handle_img(fname, color)
+        return [(os.path.join(inf,fname), color) for fname in sorted(os.listdir(inf))]
+    return [(inf, color)]
+
+def handle_task(task):
+    handle_img(*task)
+
+def main(inf):
+    print "processing %s"%inf
+    for task in target_tasks(inf):
+        handle_task(task)
+    return True
+
+# shred the given bitmaps and *.dir directories, other directories are
+# searched for PNG images and *.dir directories
+# the images of all targets are distributed over a pool of worker processes
+def shred_all(paths, jobs=1):
+    targets = []
+    for path in paths:
+        if os.path.isdir(path) and not path.rstrip(os.sep).endswith(".dir"):
+            for fname in sorted(os.listdir(path)):
+                if fname.endswith(".dir") or fname.lower().endswith(".png"):
+                    targets.append(os.path.join(path,fname))
+        else:
+            targets.append(path)
+    tasks = []
+    for inf in targets:
+        tasks.extend(target_tasks(inf))
+
+    start = time.time()
+    if jobs == 1:
+        for task in tasks:
+            handle_task(task)
     else:
-        handle_img(inf, color)
+        pool = multiprocessing.Pool(jobs)
+        try:
+            instrument.untrack(pool.map(instrument.Tracked(handle_task), tasks, chunksize=32))
+        finally:
+            pool.close()
+            pool.join()
+    print "shredded %d images of %d targets in %.2f s"%(len(tasks),len(targets),time.time()-start)
     return True
 
 if __name__ == '__main__':
-    import sys
-    if len(sys.argv) != 2:
-        print "usage: %s indir/infile"
-        exit(0)
-    ret = main(sys.argv[1])
+    import argparse
+    parser = argparse.ArgumentParser(
+        usage="%(prog)s [-j JOBS] [--stats] [--stats-json FILE] [--profile FILE] indir/infile [...]",
+        epilog="""to process the whole Data directory at once:
+    %(prog)s ~/.vcmi/Data""",
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("paths", nargs="+", metavar="indir/infile")
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+        help="number of worker processes (default: number of cpus)")
+    instrument.add_arguments(parser)
+    args = parser.parse_args()
+    # a single bitmap or *.dir directory is processed without a pool unless
+    # the number of jobs is given
+    path = args.paths[0]
+    if len(args.paths) == 1 and args.jobs is None and \
+       (not os.path.isdir(path) or path.rstrip(os.sep).endswith(".dir")):
+        ret = instrument.run(args, main, path)
+    else:
+        ret = instrument.run(args, shred_all, args.paths, args.jobs or multiprocessing.cpu_count())
     exit(0 if ret else 1)
@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2014  Johannes Schauer <j.schauer@email.de>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+# round trip tests of makedef and defextract
+#
+# run with: python -m unittest test_makedef
+
+import os
+import json
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from PIL import Image
+import defdecode
+import defextract
+import makedef
+import quantize
+
+# the frames of a DEF as a dictionary of (group,index) to their RGBA values
+# on a canvas of the full frame size
+# RGBA input is quantized again when repacking, which can reorder the palette
+def decode_def(path):
+    with open(path, "rb") as f:
+        data = f.read()
+    _,palette,offsets = defdecode.parse_header(data)
+    lut = defextract.rgba_lut(palette)
+    frames = {}
+    for bid,l in offsets.items():
+        for j,offs in enumerate(l):
+            (_,_,fw,fh,w,h,lm,tm),pixels = defdecode.decode_frame(data, offs)
+            canvas = np.zeros((fh,fw), dtype=np.uint8)
+            if w != 0 and h != 0:
+                canvas[tm:tm+h,lm:lm+w] = pixels
+            frames[bid,j] = lut[canvas]
+    return frames
+
+# random frames of palette indices with runs of the special colors, which
+# formats 2 and 3 encode as runs, and of regular colors
+def random_frame(rng, w, h):
+    flat = np.zeros(w*h, dtype=np.uint8)
+    pos = 0
+    while pos < len(flat):
+        n = rng.randint(1,80)
+        kind = rng.randint(3)
+        if kind == 0:
+            flat[pos:pos+n] = rng.randint(8)
+        elif kind == 1:
+            flat[pos:pos+n] = rng.randint(256)
+        else:
+            flat[pos:pos+n] = rng.randint(0,256,len(flat[pos:pos+n]))
+        pos += n
+    return flat.reshape(h,w)
+
+class EncoderTest(unittest.TestCase):
+    def roundtrip(self, fmt, sizes):
+        rng = np.random.RandomState(fmt)
+        for w,h in sizes:
+            pixels = random_frame(rng, w, h)
+            for optimal in (False,True):
+                if fmt == 0:
+                    data,size = makedef.encode0(pixels)
+                else:
+                    data,size = makedef.fmtencoders[fmt](pixels, optimal)
+                self.assertEqual(len(data), size)
+                out = bytearray(w*h)
+                defdecode.fmtdecoders[fmt](bytearray(data), w, h, out)
+                decoded = np.frombuffer(out, dtype=np.uint8).reshape(h,w)
+                self.assertTrue(np.array_equal(decoded, pixels), (fmt,w,h,optimal))
+
+    def test_format0(self):
+        self.roundtrip(0, [(1,1),(7,3),(64,32)])
+
+    def test_format1(self):
+        self.roundtrip(1, [(1,1),(7,3),(33,17),(300,5),(64,64)]*10)
+
+    def test_format2(self):
+        self.roundtrip(2, [(32,32)]*20)
+
+    def test_format3(self):
+        self.roundtrip(3, [(32,1),(32,32),(64,20),(96,7)]*10)
+
+    # the optimal encoding is never larger than the greedy one
+    def test_optimal(self):
+        rng = np.random.RandomState(4)
+        for fmt,(w,h) in [(1,(45,20)),(2,(32,32)),(3,(64,16))]*10:
+            pixels = random_frame(rng, w, h)
+            self.assertLessEqual(makedef.fmtencoders[fmt](pixels, True)[1],
+                                 makedef.fmtencoders[fmt](pixels)[1])
+
+class EmptyFrameTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.tmpdir, "src.dir"))
+        rng = np.random.RandomState(0)
+        px = np.zeros((40,48,4), dtype=np.uint8)
+        # few enough colors for the palette to hold all of them
+        px[5:30,8:40,:3] = rng.randint(0,16,(25,32,3))*16
+        px[5:30,8:40,3] = 0xff
+        Image.fromarray(px, 'RGBA').save(os.path.join(self.tmpdir, "src.dir", "0.png"))
+        # a fully transparent frame is cropped to 0x0
+        Image.new('RGBA', (48,40), (0,0,0,0)).save(os.path.join(self.tmpdir, "src.dir", "1.png"))
+        with open(os.path.join(self.tmpdir, "src.json"), "w") as f:
+            json.dump({"type":66, "format":1, "sequences":[
+                {"group":0, "frames":["src.dir/0.png","src.dir/1.png"]}]}, f)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_empty_image(self):
+        im = Image.new('P', (0,0))
+        self.assertEqual(makedef.encode_frame(im, 1, False), (1,0,0,'',0,0))
+        bins,counts,sums = quantize.histogram(Image.new('RGBA', (0,0)))
+        self.assertEqual((len(bins),len(counts),sums.shape), (0,0,(0,3)))
+
+    def test_roundtrip(self):
+        self.assertTrue(makedef.makedef(os.path.join(self.tmpdir, "src.json"), self.tmpdir))
+        orig = decode_def(os.path.join(self.tmpdir, "src.def"))
+        self.assertFalse(orig[0,1][:,:,3].any())
+        modes = [("default",{}), ("paletted",{"profile":defextract.profiles["compact"]}),
+                 ("crop",{"profile":defextract.OutputProfile(crop=True)}), ("dedup",{"dedup":True}),
+                 ("atlas",{"profile":defextract.OutputProfile(atlas=True)})]
+        for mode,kwargs in modes:
+            outdir = os.path.join(self.tmpdir, mode)
+            os.mkdir(outdir)
+            self.assertTrue(defextract.extract_def(os.path.join(self.tmpdir, "src.def"), outdir, **kwargs), mode)
+            self.assertTrue(makedef.makedef(os.path.join(outdir, "src.json"), outdir), mode)
+            frames = decode_def(os.path.join(outdir, "src.def"))
+            self.assertEqual(sorted(frames), sorted(orig), mode)
+            for k in orig:
+                self.assertTrue(np.array_equal(frames[k], orig[k]), mode)
+
+    def test_quantizer_state(self):
+        im = Image.open(os.path.join(self.tmpdir, "src.dir", "0.png"))
+        q = quantize.Quantizer()
+        q.add(im)
+        q.build()
+        r = quantize.Quantizer.loads(q.dumps())
+        self.assertEqual((r.palette,r.digest()), (q.palette,q.digest()))
+        same = quantize.Quantizer()
+        same.add(im)
+        self.assertTrue(r.covers(same))
+        # the source only has colors with channels which are multiples of 16
+        other = quantize.Quantizer()
+        other.add(Image.new('RGBA', (4,4), (8,8,8,0xff)))
+        self.assertFalse(r.covers(other))
+
+    def test_cached_frames(self):
+        self.assertTrue(makedef.makedef(os.path.join(self.tmpdir, "src.json"), self.tmpdir))
+        outdir = os.path.join(self.tmpdir, "rgba")
+        os.mkdir(outdir)
+        self.assertTrue(defextract.extract_def(os.path.join(self.tmpdir, "src.def"), outdir))
+        cachedir = os.path.join(self.tmpdir, "cache")
+        self.assertTrue(makedef.makedef(os.path.join(outdir, "src.json"), outdir, cachedir=cachedir))
+        # move one pixel to a color which is already in the palette
+        path = os.path.join(outdir, "src.dir", "00_00.png")
+        px = np.array(Image.open(path))
+        px[10,10] = px[20,20]
+        Image.fromarray(px, 'RGBA').save(path)
+        self.assertTrue(makedef.makedef(os.path.join(outdir, "src.json"), outdir, cachedir=cachedir))
+        with open(os.path.join(outdir, "src.def"), "rb") as f:
+            cached = f.read()
+        # encoding all frames again with the same quantizer gives the same DEF
+        shutil.rmtree(os.path.join(cachedir, "frames"))
+        os.remove(os.path.join(cachedir, "src.manifest"))
+        self.assertTrue(makedef.makedef(os.path.join(outdir, "src.json"), outdir, cachedir=cachedir))
+        with open(os.path.join(outdir, "src.def"), "rb") as f:
+            self.assertEqual(f.read(), cached)
+
+    def test_modified_atlas(self):
+        self.assertTrue(makedef.makedef(os.path.join(self.tmpdir, "src.json"), self.tmpdir))
+        outdir = os.path.join(self.tmpdir, "atlas")
+        os.mkdir(outdir)
+        self.assertTrue(defextract.extract_def(os.path.join(self.tmpdir, "src.def"), outdir,
+                                               profile=defextract.OutputProfile(atlas=True)))
+        self.assertTrue(makedef.makedef(os.path.join(outdir, "src.json"), outdir))
+        orig = decode_def(os.path.join(outdir, "src.def"))
+        # recolour the sheet, the sheet read by the first run must not be reused
+        sheet = os.path.join("src.dir", "atlas_00.png")
+        im = Image.open(os.path.join(outdir, sheet)).convert('RGBA')
+        px = np.array(im)
+        px[:,:,:3] = 0xff-px[:,:,:3]
+        Image.fromarray(px, 'RGBA').save(os.path.join(outdir, sheet))
+        self.assertTrue(makedef.makedef(os.path.join(outdir, "src.json"), outdir))
+        frames = decode_def(os.path.join(outdir, "src.def"))
+        self.assertFalse(np.array_equal(frames[0,0], orig[0,0]))
+
+if __name__ == '__main__':
+    unittest.main()